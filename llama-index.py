@@ -1,30 +1,103 @@
 import os
 import re
+import argparse
+import time
+import threading
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import Iterator, List, Dict, Optional, Sequence, Set, Union
 import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
 
 from llama_index.core import (
     VectorStoreIndex, 
     Document, 
-    StorageContext, 
-    load_index_from_storage,
-    Settings
+    Settings,
+    QueryBundle
 )
 from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode, NodeWithScore
 from llama_index.llms.openai import OpenAI
 from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from llama_index.core.retrievers import VectorIndexRetriever
 from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.response_synthesizers import get_response_synthesizer
 from llama_index.core.postprocessor import SimilarityPostprocessor
 
 from llama_index.llms.litellm import LiteLLM
 
+from vector.llm_client import SingleFlight, configure_litellm, connection_stats, context_key
+from vector.index_versions import BASE_VERSION, DirectoryWatcher, VersionedIndexStore
+from vector.dedup import MinHashDeduplicator
+from vector import index_store
+from vector.index_store import DUPLICATES_KEY, BuildCheckpoint, DedupLog, DuplicateSourcesPostprocessor
+from vector import context_packing
+from vector.context_packing import ContextPackingPostprocessor, count_context_tokens
+from vector.metrics import QueryMetrics
+from vector import autotune
+from vector.prompt_layout import CanonicalOrderPostprocessor, canonical_key, collect_llm_usage, prefix_cache_template
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=None)
+def load_embed_model(model_name: str = "BAAI/bge-small-zh-v1.5") -> HuggingFaceEmbedding:
+    """加载本地embedding模型，同名模型只加载一次"""
+    logger.info(f"正在加载本地embedding模型: {model_name}")
+    embed_model = HuggingFaceEmbedding(
+        model_name=model_name,  # 中文优化的embedding模型
+        device="cpu",  # 可以改为"cuda"如果有GPU
+        cache_folder="./models"  # 模型缓存目录
+    )
+    logger.info("embedding模型加载完成")
+    return embed_model
+
+
+def synthesize_once(single_flight: SingleFlight,
+                    llm_metrics: QueryMetrics,
+                    synthesizer,
+                    query_bundle: QueryBundle,
+                    nodes: List[NodeWithScore]):
+    """
+    调用LLM生成答案，相同(问题, 上下文)的并发请求只调用一次，实际调用的token用量计入llm_metrics
+    
+    Args:
+        synthesizer: 查询引擎或响应合成器（提供 synthesize(query_bundle, nodes)）
+    """
+    key = context_key(query_bundle.query_str, nodes)
+    
+    def synthesize():
+        with collect_llm_usage() as usage:
+            result = synthesizer.synthesize(query_bundle, nodes)
+        if usage:
+            llm_metrics.record(usage)
+            logger.info(f"LLM用量: prompt {usage.get('prompt_tokens', 0)} tokens "
+                        f"(缓存命中 {usage.get('cached_prompt_tokens', 0)}), "
+                        f"completion {usage.get('completion_tokens', 0)} tokens")
+        return result
+    
+    return single_flight.do(key, synthesize)
+
+
+def log_sources(response):
+    """输出相关的源文档信息"""
+    if hasattr(response, 'source_nodes') and response.source_nodes:
+        logger.info("相关文档:")
+        for i, node in enumerate(response.source_nodes, 1):
+            metadata = node.metadata
+            filename = metadata.get('filename', 'unknown')
+            score = getattr(node, 'score', 0)
+            corpus = f"[{metadata['corpus']}] " if metadata.get('corpus') else ""
+            logger.info(f"  {i}. {corpus}{filename} (第{metadata.get('chapter', '?')}章第{metadata.get('section', '?')}节) - 相似度: {score:.3f}")
+            # 去重时被合并掉的重复出处
+            duplicates = metadata.get(DUPLICATES_KEY)
+            if duplicates:
+                logger.info(f"     同见: {', '.join(duplicates)}")
+
+
 class RAGDocumentProcessor:
     """RAG文档处理器，用于构建和查询向量库"""
     
@@ -33,7 +106,11 @@ class RAGDocumentProcessor:
                  storage_dir: str = "./storage",
                  chunk_size: int = 512,
                  chunk_overlap: int = 50,
-                 deepseek_api_key: Optional[str] = None):
+                 deepseek_api_key: Optional[str] = None,
+                 max_connections: int = 20,
+                 max_keepalive_connections: int = 10,
+                 dedup_threshold: Optional[float] = 0.9,
+                 use_llm: bool = True):
         """
         初始化RAG文档处理器
         
@@ -43,15 +120,58 @@ class RAGDocumentProcessor:
             chunk_size: 文档切分块大小
             chunk_overlap: 文档切分重叠大小
             deepseek_api_key: DeepSeek API密钥
+            max_connections: 共享HTTP连接池的最大连接数
+            max_keepalive_connections: 连接池中保持长连接的最大数量
+            dedup_threshold: 近重复去重的相似度阈值（估计的Jaccard系数），None表示不去重
+            use_llm: 是否配置LLM；只建索引或做参数搜索时可设为False，此时不需要API密钥
         """
         self.documents_dir = Path(documents_dir)
         self.storage_dir = Path(storage_dir)
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        self.dedup_threshold = dedup_threshold
+        self.build_stats: Dict[str, object] = {}
         
         # 创建存储目录
-        self.storage_dir.mkdir(exist_ok=True)
+        self.storage_dir.mkdir(parents=True, exist_ok=True)
+        
+        if use_llm:
+            self._configure_llm(deepseek_api_key, max_connections, max_keepalive_connections)
+        
+        # 使用本地中文优化的embedding模型（进程内只加载一次，多个语料共用）
+        Settings.embed_model = load_embed_model()
+        
+        # 初始化节点解析器
+        self.node_parser = SentenceSplitter(
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap
+        )
+        
+        self.index = None
+        self.index_path: Optional[Path] = None
+        self.query_engine = None
+        
+        # 相同(问题, 检索上下文)的并发查询只调用一次LLM
+        self.single_flight = SingleFlight()
+        self.query_metrics = QueryMetrics()
+        # 跳过上下文压缩的查询单独统计，与query_metrics对比压缩前后的延迟
+        self.unpacked_metrics = QueryMetrics(count_name='unpacked_queries')
+        # 实际发出的LLM调用的token用量（含缓存命中），被合并的查询不重复计入
+        self.llm_metrics = QueryMetrics(count_name='synthesized_queries')
         
+        # 热更新：版本化索引存储与文档目录监听
+        self.versions = VersionedIndexStore(self.storage_dir, on_release=index_store.release)
+        self._watcher: Optional[DirectoryWatcher] = None
+        self._engine_kwargs: Dict[str, object] = {}
+        self.index_version: Optional[str] = None
+        # 保证 (index, index_version, query_engine) 三者一起切换
+        self._swap_lock = threading.Lock()
+    
+    def _configure_llm(self, 
+                       deepseek_api_key: Optional[str], 
+                       max_connections: int, 
+                       max_keepalive_connections: int):
+        """配置DeepSeek LLM及其共享连接池"""
         # 获取DeepSeek API密钥
         if deepseek_api_key:
             self.api_key = deepseek_api_key
@@ -63,30 +183,19 @@ class RAGDocumentProcessor:
         # 设置DeepSeek环境变量
         os.environ["DEEPSEEK_API_KEY"] = self.api_key
         
+        # 所有LiteLLM调用共用一个有界的keep-alive连接池（需作为client参数随每次调用传入）
+        http_handler = configure_litellm(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections
+        )
+        
         # 配置LlamaIndex设置 - 使用LiteLLM调用DeepSeek
         Settings.llm = LiteLLM(
             model="deepseek/deepseek-chat",  # LiteLLM格式的DeepSeek模型
             api_key=self.api_key,
-            temperature=0.1
-        )
-        
-        # 使用本地中文优化的embedding模型
-        logger.info("正在加载本地embedding模型: BAAI/bge-small-zh-v1.5")
-        Settings.embed_model = HuggingFaceEmbedding(
-            model_name="BAAI/bge-small-zh-v1.5",  # 中文优化的embedding模型
-            device="cpu",  # 可以改为"cuda"如果有GPU
-            cache_folder="./models"  # 模型缓存目录
+            temperature=0.1,
+            additional_kwargs={'client': http_handler}
         )
-        logger.info("embedding模型加载完成")
-        
-        # 初始化节点解析器
-        self.node_parser = SentenceSplitter(
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap
-        )
-        
-        self.index = None
-        self.query_engine = None
     
     def parse_filename(self, filename: str) -> Optional[Dict[str, object]]:
         """
@@ -114,7 +223,21 @@ class RAGDocumentProcessor:
         Returns:
             Document对象列表
         """
-        documents = []
+        documents = list(self.iter_documents())
+        logger.info(f"成功加载 {len(documents)} 个文档")
+        return documents
+    
+    def iter_documents(self, skip: Optional[Set[str]] = None) -> Iterator[Document]:
+        """
+        逐个读取文档，同一时刻只在内存中保留一个文件的内容
+        
+        Args:
+            skip: 需要跳过的文件名集合（断点续建时已完成的文件）
+            
+        Returns:
+            Document对象生成器
+        """
+        skip = skip or set()
         
         # 获取所有txt文件并排序
         txt_files = sorted([f for f in self.documents_dir.glob("*.txt") 
@@ -123,6 +246,8 @@ class RAGDocumentProcessor:
         logger.info(f"找到 {len(txt_files)} 个文档文件")
         
         for file_path in txt_files:
+            if file_path.name in skip:
+                continue
             try:
                 # 解析文件名
                 file_info = self.parse_filename(file_path.name)
@@ -152,122 +277,514 @@ class RAGDocumentProcessor:
                     metadata=metadata
                 )
                 
-                documents.append(document)
-                logger.info(f"加载文档: {file_path.name} (第{file_info['chapter']}章第{file_info['section']}节)")
-                
             except Exception as e:
                 logger.error(f"加载文档 {file_path.name} 时出错: {e}")
-        
-        logger.info(f"成功加载 {len(documents)} 个文档")
-        return documents
+                continue
+            
+            logger.info(f"加载文档: {file_path.name} (第{file_info['chapter']}章第{file_info['section']}节)")
+            yield document
     
     def build_vector_index(self, force_rebuild: bool = False):
         """
         构建或加载向量索引
         
         Args:
-            force_rebuild: 是否强制重建索引
+            force_rebuild: 是否强制重建索引（丢弃已有索引与未完成构建的断点）
         """
-        index_path = self.storage_dir / "index"
+        # 热更新产生过新版本时优先加载CURRENT指向的版本
+        current_dir = self.versions.current_dir()
+        index_path = current_dir or self.storage_dir / "index"
+        # 启动时的版本在create_query_engine中publish，之后查询与热更新一样受引用计数保护
+        self.index_version = current_dir.name if current_dir else BASE_VERSION
+        self.index_path = index_path
         
-        # 如果存在已保存的索引且不强制重建，则加载
-        if index_path.exists() and not force_rebuild:
-            logger.info("加载现有向量索引...")
+        # 如果存在已保存的完整索引且不强制重建，则加载；未完成的构建会在下面续建
+        building = (index_path / index_store.BUILD_CHECKPOINT).exists()
+        if index_path.exists() and not force_rebuild and not building:
+            logger.info(f"加载现有向量索引: {index_path}")
             try:
-                storage_context = StorageContext.from_defaults(
-                    persist_dir=str(index_path)
-                )
-                loaded_index = load_index_from_storage(storage_context)
-                # 如果不是VectorStoreIndex，则直接赋值
-                self.index = loaded_index
+                self.index = index_store.load_index(index_path)
                 logger.info("向量索引加载成功")
                 return
             except Exception as e:
                 logger.warning(f"加载索引失败: {e}，将重新构建")
         
-        # 构建新索引
-        logger.info("开始构建向量索引...")
+        self.index = self._build_index(index_path, force_rebuild=force_rebuild)
+    
+    def _build_index(self, 
+                     index_path: Path,
+                     force_rebuild: bool = False,
+                     embed_batch_size: int = 64,
+                     flush_every: int = 10) -> VectorStoreIndex:
+        """
+        以流式管道构建向量索引并保存到指定目录
         
-        # 加载文档
-        documents = self.load_documents()
-        if not documents:
+        逐个文件 读取 -> 切分 -> 去重 -> 分批embedding -> 追加写入磁盘向量库，
+        内存中只保留当前批次的节点。每处理 flush_every 个文件在断点中追加一行，
+        中断后再次调用会从断点续建；断点之后被修改或删除的文件会重新处理。
+        
+        Args:
+            index_path: 索引保存目录
+            force_rebuild: 是否丢弃断点与已写入的部分索引，从头构建
+            embed_batch_size: 每批embedding的节点数
+            flush_every: 每处理多少个文件记录一次断点
+            
+        Returns:
+            新构建的向量索引
+        """
+        checkpoint = BuildCheckpoint(index_path, {
+            'chunk_size': self.chunk_size,
+            'chunk_overlap': self.chunk_overlap,
+            'dedup_threshold': self.dedup_threshold,
+        })
+        dedup_log = DedupLog(index_path)
+        files = None if force_rebuild else checkpoint.load()
+        
+        if files is None:
+            logger.info("开始构建向量索引...")
+            index_store.clear_build(index_path)
+            # 先写断点，避免中途崩溃后把半成品当成完整索引加载
+            checkpoint.start()
+            files = {}
+            vector_store = index_store.open_vector_store(index_path)
+        else:
+            vector_store = index_store.open_vector_store(index_path)
+            files = self._resume_build(vector_store, checkpoint, dedup_log, files)
+            logger.info(f"从断点续建向量索引，已完成 {len(files)} 个文件")
+        
+        # 去重器只保存签名，续建时用已入库的节点重新填充
+        dedup = None
+        if self.dedup_threshold is not None:
+            dedup = MinHashDeduplicator(threshold=self.dedup_threshold)
+            for node_id, text in index_store.iter_stored_texts(vector_store):
+                dedup.add(node_id, text)
+        
+        batch = []
+        node_count = 0
+        pending_files: Dict[str, Dict[str, object]] = {}
+        pending_duplicates: List[Dict[str, str]] = []
+        for document in self.iter_documents(skip=set(files)):
+            stats = {'hash': index_store.content_hash(document.text), 'parsed': 0, 'dropped': 0}
+            # 解析文档为节点（按段落切分）
+            for node in self.node_parser.get_nodes_from_documents([document]):
+                stats['parsed'] += 1
+                
+                # 在embedding之前丢弃近重复节点，记录其指向的代表节点
+                if dedup is not None:
+                    representative_id = dedup.add(node.node_id, node.get_content())
+                    if representative_id is not None:
+                        pending_duplicates.append({
+                            'node_id': node.node_id,
+                            'representative': representative_id,
+                            'chapter_section': node.metadata.get('chapter_section'),
+                            'filename': node.metadata.get('filename'),
+                        })
+                        stats['dropped'] += 1
+                        continue
+                
+                batch.append(node)
+                if len(batch) >= embed_batch_size:
+                    node_count += self._embed_and_insert(vector_store, batch)
+                    batch = []
+            pending_files[document.metadata['filename']] = stats
+            
+            if len(pending_files) >= flush_every:
+                node_count += self._embed_and_insert(vector_store, batch)
+                batch = []
+                self._flush(checkpoint, dedup_log, pending_files, pending_duplicates)
+                files.update(pending_files)
+                pending_files, pending_duplicates = {}, []
+        
+        node_count += self._embed_and_insert(vector_store, batch)
+        self._flush(checkpoint, dedup_log, pending_files, pending_duplicates)
+        files.update(pending_files)
+        if not files:
             raise ValueError("没有找到有效的文档文件")
         
-        # 解析文档为节点（按段落切分）
-        nodes = self.node_parser.get_nodes_from_documents(documents, show_progress=True)
-        logger.info(f"文档解析完成，共生成 {len(nodes)} 个节点")
+        # 向量库已随写入持久化，删除断点即表示构建完成
+        checkpoint.finish()
+        
+        parsed = sum(stats['parsed'] for stats in files.values())
+        dropped = sum(stats['dropped'] for stats in files.values())
+        self.build_stats = {
+            'parsed_nodes': parsed,
+            'indexed_nodes': parsed - dropped,
+            'dropped_nodes': dropped,
+            'shrink_ratio': dropped / parsed if parsed else 0.0,
+        }
+        logger.info(f"向量索引构建完成并保存到: {index_path}（本次新增 {node_count} 个节点）")
+        logger.info(f"近重复去重: 解析 {parsed} 个节点，丢弃 {dropped} 个，"
+                    f"索引缩小 {self.build_stats['shrink_ratio']:.1%}")
+        return VectorStoreIndex.from_vector_store(vector_store)
+    
+    def _resume_build(self, 
+                      vector_store, 
+                      checkpoint: BuildCheckpoint, 
+                      dedup_log: DedupLog,
+                      files: Dict[str, Dict[str, object]]) -> Dict[str, Dict[str, object]]:
+        """
+        续建前清理：断点之后被修改或删除的文件、最后一次断点之后写入的节点都需要重新处理
         
-        # 构建向量索引
-        self.index = VectorStoreIndex(nodes, show_progress=True)
+        去重时指向被删除节点的重复节点也失去了代表，其所在文件一并重新处理。
+        
+        Returns:
+            仍然有效的已完成文件
+        """
+        current = self._file_hashes()
+        keep = {name for name, stats in files.items() if current.get(name) == stats['hash']}
+        changed = sorted(set(files) - keep)
+        if changed:
+            logger.info(f"断点之后有 {len(changed)} 个文件被修改或删除，将重新处理: {', '.join(changed)}")
+        
+        entries = dedup_log.read()
+        while True:
+            stale = set(index_store.stale_node_ids(vector_store, keep))
+            orphaned = {e['filename'] for e in entries
+                        if e['filename'] in keep and e['representative'] in stale}
+            if not orphaned:
+                break
+            keep -= orphaned
         
-        # 保存索引
-        self.index.storage_context.persist(persist_dir=str(index_path))
-        logger.info(f"向量索引构建完成并保存到: {index_path}")
+        kept_entries = [e for e in entries if e['filename'] in keep]
+        if stale or len(kept_entries) != len(entries) or len(keep) != len(files):
+            index_store.delete_nodes(vector_store, sorted(stale))
+            dedup_log.rewrite(kept_entries)
+            files = {name: files[name] for name in keep}
+            checkpoint.start(files)
+        return files
+    
+    def _file_hashes(self) -> Dict[str, str]:
+        """当前文档目录中各文件的内容哈希（逐个读取）"""
+        hashes = {}
+        for file_path in self.documents_dir.glob("*.txt"):
+            if self.parse_filename(file_path.name):
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    hashes[file_path.name] = index_store.content_hash(f.read().strip())
+        return hashes
+    
+    def _embed_and_insert(self, vector_store, nodes: List) -> int:
+        """批量计算节点embedding并追加写入向量库，返回写入的节点数"""
+        if not nodes:
+            return 0
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        embeddings = Settings.embed_model.get_text_embedding_batch(texts)
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        vector_store.add(nodes)
+        return len(nodes)
+    
+    def _flush(self, 
+               checkpoint: BuildCheckpoint, 
+               dedup_log: DedupLog, 
+               files: Dict[str, Dict[str, object]],
+               duplicates: List[Dict[str, str]]):
+        """追加去重映射，再追加断点（先数据后断点，保证断点记录的文件都已持久化）"""
+        if not files:
+            return
+        dedup_log.append(duplicates)
+        checkpoint.record(files)
+        logger.info(f"已记录断点，本批完成 {len(files)} 个文件")
+    
+    def reload_index(self):
+        """
+        在新的版本目录中重建索引，完成后原子切换索引和查询引擎
+        
+        正在执行的查询继续使用旧版本，旧版本在不再被引用后清理。
+        """
+        version, version_dir = self.versions.new_version_dir()
+        try:
+            index = self._build_index(version_dir)
+            engine = self._make_query_engine(index, version_dir, **self._engine_kwargs)
+        except Exception:
+            self.versions.discard(version)
+            raise
+        with self._swap_lock:
+            self.index = index
+            self.index_path = version_dir
+            self.index_version = version
+            self.query_engine = engine
+            self.versions.publish(version, engine)
+    
+    def start_hot_reload(self, poll_interval: float = 5.0):
+        """
+        开始监听文档目录，文件变化时在后台重建并切换索引
+        
+        Args:
+            poll_interval: 轮询间隔（秒）
+        """
+        if self._watcher is not None:
+            return
+        self._watcher = DirectoryWatcher(
+            self.documents_dir,
+            on_change=self.reload_index,
+            poll_interval=poll_interval
+        )
+        self._watcher.start()
+        logger.info(f"已开启索引热更新，监听目录: {self.documents_dir}")
+    
+    def stop_hot_reload(self):
+        """停止监听文档目录"""
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher.join()
+            self._watcher = None
+    
+    def close(self):
+        """
+        释放已加载的索引：停止热更新，丢弃索引与各版本的查询引擎，关闭其向量库
+        
+        关闭后需重新调用 build_vector_index 才能查询。
+        """
+        self.stop_hot_reload()
+        with self._swap_lock:
+            index_path = self.index_path
+            self.index = None
+            self.index_path = None
+            self.query_engine = None
+        self.versions.close()
+        if index_path is not None:
+            index_store.release(index_path)
     
     def create_query_engine(self, 
                           similarity_top_k: int = 5,
-                          similarity_cutoff: float = 0.7):
+                          similarity_cutoff: float = 0.7,
+                          context_token_budget: Optional[int] = 3072,
+                          prefix_cache_layout: bool = False):
         """
         创建查询引擎
         
         Args:
             similarity_top_k: 检索的相似文档数量
             similarity_cutoff: 相似度阈值
+            context_token_budget: 送入LLM的上下文token上限，None表示不做上下文压缩
+            prefix_cache_layout: 是否使用前缀缓存友好的提示词布局（固定指令在前，上下文按章节排序）
         """
         if self.index is None:
             raise ValueError("请先构建向量索引")
         
-        # 创建检索器
-        from llama_index.core import VectorStoreIndex
-
-        if not isinstance(self.index, VectorStoreIndex):
+        self._engine_kwargs = {
+            'similarity_top_k': similarity_top_k,
+            'similarity_cutoff': similarity_cutoff,
+            'context_token_budget': context_token_budget,
+            'prefix_cache_layout': prefix_cache_layout,
+        }
+        with self._swap_lock:
+            self.query_engine = self._make_query_engine(self.index, self.index_path, **self._engine_kwargs)
+            # 注册/更新当前版本的查询引擎，参数变化后新的查询立即使用新引擎
+            self.versions.publish(self.index_version or BASE_VERSION, self.query_engine)
+        
+        logger.info("查询引擎创建完成")
+    
+    def _make_query_engine(self, 
+                           index,
+                           index_path: Optional[Path] = None,
+                           similarity_top_k: int = 5,
+                           similarity_cutoff: float = 0.7,
+                           context_token_budget: Optional[int] = 3072,
+                           prefix_cache_layout: bool = False) -> RetrieverQueryEngine:
+        """为给定索引创建查询引擎"""
+        if not isinstance(index, VectorStoreIndex):
             raise TypeError("self.index 必须是 VectorStoreIndex 类型。请检查索引加载和构建逻辑。")
 
+        # 创建检索器
         retriever = VectorIndexRetriever(
-            index=self.index,
+            index=index,
             similarity_top_k=similarity_top_k,
         )
         
-        # 创建后处理器
-        postprocessor = SimilarityPostprocessor(similarity_cutoff=similarity_cutoff)
+        # 创建后处理器：先按相似度过滤并标注重复出处，再合并相邻块并按token预算压缩
+        postprocessors = [SimilarityPostprocessor(similarity_cutoff=similarity_cutoff)]
+        if index_path is not None:
+            postprocessors.append(DuplicateSourcesPostprocessor(index_path=str(index_path)))
+        if context_token_budget is not None:
+            postprocessors.append(ContextPackingPostprocessor(token_budget=context_token_budget))
+        
+        if prefix_cache_layout:
+            # 上下文按章节和节点ID排序，相同章节组合产生相同的提示词前缀
+            postprocessors.append(CanonicalOrderPostprocessor())
+            return RetrieverQueryEngine.from_args(
+                retriever=retriever,
+                node_postprocessors=postprocessors,
+                text_qa_template=prefix_cache_template()
+            )
         
         # 创建查询引擎
-        self.query_engine = RetrieverQueryEngine(
+        return RetrieverQueryEngine(
             retriever=retriever,
-            node_postprocessors=[postprocessor]
+            node_postprocessors=postprocessors
         )
-        
-        logger.info("查询引擎创建完成")
     
-    def query(self, question: str) -> str:
+    def query(self, question: str, pack_context: bool = True) -> str:
         """
         查询向量库
         
         Args:
             question: 查询问题
+            pack_context: 是否压缩上下文；为False时跳过压缩，单独统计延迟，便于对比压缩的收益
             
         Returns:
             查询结果
         """
+        logger.info(f"查询问题: {question}")
+        start = time.perf_counter()
+        
+        with self._engine() as query_engine:
+            # 先检索，再以(问题, 检索上下文)为键合并在途的LLM调用
+            query_bundle = QueryBundle(question)
+            packed = pack_context and self._packer(query_engine) is not None
+            nodes = self._retrieve(query_engine, query_bundle, pack_context)
+            # 统计取自本次实际使用的引擎，热更新或重建引擎后不会错位
+            packing = context_packing.last_stats() if packed else {}
+            response = self._synthesize(query_engine, query_bundle, nodes)
+        
+        latency = time.perf_counter() - start
+        context_tokens = packing.get('context_tokens_after') or count_context_tokens(nodes)
+        if pack_context:
+            self.query_metrics.record({
+                'latency_s': latency,
+                'context_tokens_before': packing.get('context_tokens_before', context_tokens),
+                'context_tokens_after': context_tokens,
+            })
+        else:
+            self.unpacked_metrics.record({
+                'unpacked_latency_s': latency,
+                'unpacked_context_tokens': context_tokens,
+            })
+        if packing:
+            logger.info(f"上下文压缩: {packing['nodes_before']} -> {packing['nodes_after']} 个节点, "
+                        f"{packing['context_tokens_before']} -> {packing['context_tokens_after']} tokens, "
+                        f"耗时 {latency:.2f}s")
+        
+        self._log_sources(response)
+        return str(response)
+    
+    def retrieve(self, question: str, pack_context: bool = True) -> List[NodeWithScore]:
+        """
+        只检索不生成答案（经过相似度过滤与上下文压缩）
+        
+        Args:
+            question: 查询问题
+            pack_context: 是否压缩上下文
+            
+        Returns:
+            检索到的节点列表
+        """
+        with self._engine() as query_engine:
+            return self._retrieve(query_engine, QueryBundle(question), pack_context)
+    
+    def _packer(self, query_engine: RetrieverQueryEngine) -> Optional[ContextPackingPostprocessor]:
+        """引擎中的上下文压缩后处理器，未配置压缩时为None"""
+        return next((p for p in query_engine._node_postprocessors
+                     if isinstance(p, ContextPackingPostprocessor)), None)
+    
+    def _retrieve(self, 
+                  query_engine: RetrieverQueryEngine, 
+                  query_bundle: QueryBundle, 
+                  pack_context: bool = True) -> List[NodeWithScore]:
+        """用给定引擎检索；不压缩时依次执行除上下文压缩以外的后处理器"""
+        if pack_context:
+            return query_engine.retrieve(query_bundle)
+        nodes = query_engine.retriever.retrieve(query_bundle)
+        for postprocessor in query_engine._node_postprocessors:
+            if not isinstance(postprocessor, ContextPackingPostprocessor):
+                nodes = postprocessor.postprocess_nodes(nodes, query_bundle=query_bundle)
+        return nodes
+    
+    @contextmanager
+    def _engine(self) -> Iterator[RetrieverQueryEngine]:
+        """持有当前索引版本的查询引擎直到with块结束，热更新切换不影响本次查询"""
         if self.query_engine is None:
             self.create_query_engine()
+        with self.versions.acquire() as (version, engine):
+            query_engine = engine or self.query_engine
+            if query_engine is None or not hasattr(query_engine, "query"):
+                raise AttributeError("query_engine 未正确初始化或不包含 'query' 方法")
+            yield query_engine
+    
+    def _synthesize(self, 
+                    query_engine: RetrieverQueryEngine, 
+                    query_bundle: QueryBundle, 
+                    nodes: List[NodeWithScore]):
+        """调用LLM生成答案，相同(问题, 上下文)的并发请求只调用一次"""
+        return synthesize_once(self.single_flight, self.llm_metrics, query_engine, query_bundle, nodes)
+    
+    def _log_sources(self, response):
+        """输出相关的源文档信息"""
+        log_sources(response)
+    
+    def estimate_memory_bytes(self) -> int:
+        """
+        估算已加载索引占用的内存
         
-        logger.info(f"查询问题: {question}")
-        if self.query_engine is None or not hasattr(self.query_engine, "query"):
-            raise AttributeError("query_engine 未正确初始化或不包含 'query' 方法")
-        response = self.query_engine.query(question)
-        
-        # 输出相关的源文档信息
-        if hasattr(response, 'source_nodes') and response.source_nodes:
-            logger.info("相关文档:")
-            for i, node in enumerate(response.source_nodes, 1):
-                metadata = node.metadata
-                chapter_section = metadata.get('chapter_section', 'unknown')
-                filename = metadata.get('filename', 'unknown')
-                score = getattr(node, 'score', 0)
-                logger.info(f"  {i}. {filename} (第{metadata.get('chapter', '?')}章第{metadata.get('section', '?')}节) - 相似度: {score:.3f}")
+        磁盘向量库按其文件大小估算（查询时HNSW图与向量常驻内存）；
+        旧格式的SimpleVectorStore以Python float列表保存向量（每个约32字节），文档库保存节点文本。
         
-        return str(response)
+        Returns:
+            估算的字节数，未加载索引时为0
+        """
+        if self.index is None:
+            return 0
+        if self.index_path is not None and index_store.has_disk_store(self.index_path):
+            chroma_dir = self.index_path / index_store.CHROMA_DIRNAME
+            return sum(f.stat().st_size for f in chroma_dir.rglob("*") if f.is_file())
+        data = getattr(self.index.vector_store, 'data', None)
+        embeddings = getattr(data, 'embedding_dict', {}) or {}
+        size = sum(len(e) for e in embeddings.values()) * 32
+        size += sum(len(node.get_content()) * 4 for node in self.index.docstore.docs.values())
+        return size
+    
+    def get_metrics(self) -> Dict[str, object]:
+        """
+        获取查询延迟与上下文token、LLM用量与缓存命中、请求合并率与HTTP连接复用情况
+        
+        Returns:
+            指标字典
+        """
+        metrics: Dict[str, object] = {}
+        metrics.update(self.query_metrics.snapshot())
+        metrics.update(self.unpacked_metrics.snapshot())
+        metrics.update(self.llm_metrics.snapshot())
+        prompt_tokens = metrics.get('prompt_tokens_total', 0)
+        metrics['prompt_cache_hit_rate'] = (
+            metrics.get('cached_prompt_tokens_total', 0) / prompt_tokens if prompt_tokens else 0.0
+        )
+        metrics.update(self.single_flight.snapshot())
+        metrics.update(connection_stats.snapshot())
+        return metrics
+    
+    def autotune(self, 
+                 golden_path: str, 
+                 grid: Optional[Dict[str, List]] = None,
+                 pareto_only: bool = True,
+                 context_token_budget: Optional[int] = 3072) -> str:
+        """
+        在标准问题集上网格搜索切分与检索参数
+        
+        每组配置与线上一样经过近重复去重（使用本处理器的dedup_threshold）和上下文压缩。
+        切分结果与embedding按内容哈希缓存在 storage/tune_cache 下，多次运行和不同配置之间复用。
+        
+        Args:
+            golden_path: 标准问题集路径（jsonl，每行含question与sections）
+            grid: 参数网格，如 {'chunk_size': [512, 1024]}，未给出的参数使用默认网格
+            pareto_only: 是否只输出帕累托最优的配置
+            context_token_budget: 上下文压缩的token预算，应与create_query_engine一致
+            
+        Returns:
+            recall@k与索引体积、检索延迟、上下文token的Markdown对比表
+        """
+        golden = autotune.load_golden_set(golden_path)
+        documents = list(self.iter_documents())
+        logger.info(f"开始参数搜索: {len(documents)} 个文档, {len(golden)} 个标准问题")
+        rows = autotune.sweep(
+            documents,
+            golden,
+            embed_model=Settings.embed_model,
+            cache_dir=str(self.storage_dir / "tune_cache"),
+            grid=grid,
+            dedup_threshold=self.dedup_threshold,
+            context_token_budget=context_token_budget
+        )
+        return autotune.format_table(rows, pareto_only=pareto_only)
     
     def get_chapter_sections(self) -> List[str]:
         """
@@ -288,9 +805,287 @@ class RAGDocumentProcessor:
         return sections
 
 
+class CorpusRegistry:
+    """
+    多语料索引注册表：一个进程内管理多本手册，每个语料有独立的持久化索引
+    
+    索引在第一次查询时加载；已加载索引的估算内存超过预算时，按LRU淘汰最久未用且没有查询在用的语料。
+    """
+    
+    def __init__(self,
+                 storage_root: str = "./storage/corpora",
+                 memory_budget_mb: float = 1024,
+                 engine_kwargs: Optional[Dict[str, object]] = None,
+                 **processor_kwargs):
+        """
+        初始化注册表
+        
+        Args:
+            storage_root: 各语料索引的默认存储根目录（每个语料一个子目录）
+            memory_budget_mb: 已加载索引的内存预算（MB）
+            engine_kwargs: 传给create_query_engine的参数
+            processor_kwargs: 传给RAGDocumentProcessor的公共参数（如chunk_size、deepseek_api_key）
+        """
+        self.storage_root = Path(storage_root)
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.engine_kwargs = engine_kwargs or {}
+        self.processor_kwargs = processor_kwargs
+        
+        self._corpora: Dict[str, Dict[str, object]] = {}
+        # 已加载的语料，按最近使用排序（最后的最新）
+        self._loaded: "OrderedDict[str, RAGDocumentProcessor]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        # 正在使用各语料的查询数，大于0的语料不会被淘汰
+        self._pins: Dict[str, int] = {}
+        # 只保护上面的注册表状态，加载索引时不持有
+        self._lock = threading.Lock()
+        # 每个语料一把加载锁，同一语料只加载一次，不同语料可以并行加载
+        self._load_locks: Dict[str, threading.Lock] = {}
+        
+        # 跨语料查询：合并后的上下文压缩、合成与指标
+        budget = self.engine_kwargs.get('context_token_budget', 3072)
+        self._packer = ContextPackingPostprocessor(token_budget=budget) if budget is not None else None
+        self._synthesizer = None
+        self.single_flight = SingleFlight()
+        self.query_metrics = QueryMetrics(count_name='fanout_queries')
+        self.llm_metrics = QueryMetrics(count_name='fanout_synthesized_queries')
+    
+    def register(self, name: str, documents_dir: str, storage_dir: Optional[str] = None, **overrides):
+        """
+        注册一个语料（不会立即加载）
+        
+        Args:
+            name: 语料名称
+            documents_dir: 该语料的章节文件目录
+            storage_dir: 索引存储目录，默认 storage_root/<name>
+            overrides: 只对该语料生效的RAGDocumentProcessor参数
+        """
+        with self._lock:
+            self._corpora[name] = {
+                'documents_dir': documents_dir,
+                'storage_dir': storage_dir or str(self.storage_root / name),
+                **overrides,
+            }
+        logger.info(f"注册语料: {name} ({documents_dir})")
+    
+    def discover(self, library_dir: str) -> List[str]:
+        """
+        把目录下每个包含章节文件（如 1_1.txt）的子目录注册为一个语料，子目录名即语料名
+        
+        Args:
+            library_dir: 文档库根目录
+            
+        Returns:
+            新注册的语料名称列表
+        """
+        names = []
+        for sub_dir in sorted(Path(library_dir).iterdir()):
+            if sub_dir.is_dir() and any(re.match(r'\d+_\d+\.txt$', f.name) for f in sub_dir.glob("*.txt")):
+                self.register(sub_dir.name, str(sub_dir))
+                names.append(sub_dir.name)
+        return names
+    
+    def corpora(self) -> List[str]:
+        """所有已注册的语料名称"""
+        return list(self._corpora)
+    
+    def get(self, name: str) -> RAGDocumentProcessor:
+        """
+        获取语料的处理器，未加载时加载其索引，并按内存预算淘汰其他语料
+        
+        返回的处理器未被持有，被淘汰时会关闭（释放索引），之后不能再查询；
+        需要查询时使用 query()，查询期间语料不会被淘汰。
+        
+        Args:
+            name: 语料名称
+            
+        Returns:
+            已加载索引的RAGDocumentProcessor
+        """
+        with self._use(name) as processor:
+            return processor
+    
+    @contextmanager
+    def _use(self, name: str) -> Iterator[RAGDocumentProcessor]:
+        """持有语料直到with块结束，期间不会被淘汰"""
+        processor = self._acquire(name)
+        try:
+            yield processor
+        finally:
+            with self._lock:
+                self._pins[name] -= 1
+                if not self._pins[name]:
+                    del self._pins[name]
+            # 之前因为在用而没能淘汰的语料，现在可能可以淘汰了
+            self._evict()
+    
+    def _acquire(self, name: str) -> RAGDocumentProcessor:
+        """获取并引用计数+1，未加载时在该语料的加载锁下加载"""
+        with self._lock:
+            if name not in self._corpora:
+                raise KeyError(f"未注册的语料: {name}")
+            processor = self._pin_loaded(name)
+            if processor is not None:
+                return processor
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        
+        with load_lock:
+            # 等锁期间可能已被其他线程加载
+            with self._lock:
+                processor = self._pin_loaded(name)
+                if processor is not None:
+                    return processor
+                config = {**self.processor_kwargs, **self._corpora[name]}
+            
+            logger.info(f"加载语料索引: {name}")
+            processor = RAGDocumentProcessor(**config)
+            processor.build_vector_index(force_rebuild=False)
+            processor.create_query_engine(**self.engine_kwargs)
+            size = processor.estimate_memory_bytes()
+            
+            with self._lock:
+                self._loaded[name] = processor
+                self._sizes[name] = size
+                self._pins[name] = self._pins.get(name, 0) + 1
+        
+        self._evict()
+        return processor
+    
+    def _pin_loaded(self, name: str) -> Optional[RAGDocumentProcessor]:
+        """已加载时标记为最近使用并引用计数+1（调用方持有self._lock）"""
+        processor = self._loaded.get(name)
+        if processor is not None:
+            self._loaded.move_to_end(name)
+            self._pins[name] = self._pins.get(name, 0) + 1
+        return processor
+    
+    def _evict(self):
+        """超出内存预算时淘汰最久未使用且没有查询在用的语料"""
+        evicted = []
+        with self._lock:
+            while sum(self._sizes.values()) > self.memory_budget:
+                name = next((n for n in self._loaded if not self._pins.get(n)), None)
+                if name is None:
+                    break
+                evicted.append((name, self._loaded.pop(name), self._sizes.pop(name)))
+        
+        # 没有查询在用，关闭处理器并释放chroma缓存的索引，内存才会真正归还
+        for name, processor, size in evicted:
+            processor.close()
+            logger.info(f"内存超出预算，淘汰语料: {name}（约 {size / 1024 / 1024:.1f} MB）")
+    
+    def query(self, 
+              question: str, 
+              corpora: Union[str, Sequence[str], None] = None,
+              similarity_top_k: Optional[int] = None) -> str:
+        """
+        查询一个或多个语料
+        
+        Args:
+            question: 查询问题
+            corpora: 语料名称或名称列表，None表示查询全部语料
+            similarity_top_k: 合并后保留的节点数（单语料与多语料相同），
+                None时使用engine_kwargs中的similarity_top_k；
+                每个语料最多贡献其查询引擎检索到的节点数
+            
+        Returns:
+            查询结果
+        """
+        if isinstance(corpora, str):
+            corpora = [corpora]
+        names = list(corpora) if corpora is not None else self.corpora()
+        if not names:
+            raise ValueError("没有可查询的语料")
+        if len(names) == 1 and similarity_top_k is None:
+            # 单语料且不改top-k时直接使用其查询引擎
+            with self._use(names[0]) as processor:
+                return processor.query(question)
+        if similarity_top_k is None:
+            similarity_top_k = self.engine_kwargs.get('similarity_top_k', 5)
+        
+        logger.info(f"查询问题: {question}")
+        start = time.perf_counter()
+        query_bundle = QueryBundle(question)
+        
+        # 各语料分别检索（相似度过滤，不压缩），合并后按相似度取top-k（单语料指定top-k时同样走这里）
+        merged: List[NodeWithScore] = []
+        for name in names:
+            with self._use(name) as processor:
+                nodes = processor.retrieve(question, pack_context=False)
+            for node in nodes:
+                node.node.metadata['corpus'] = name
+                merged.append(node)
+        merged.sort(key=lambda n: n.score or 0.0, reverse=True)
+        merged = merged[:similarity_top_k]
+        
+        # 与单语料查询一样：合并后的上下文按token预算压缩，再按固定顺序排列
+        packing = {}
+        if self._packer is not None:
+            merged = self._packer.postprocess_nodes(merged, query_bundle=query_bundle)
+            packing = context_packing.last_stats()
+        prefix_cache_layout = self.engine_kwargs.get('prefix_cache_layout', False)
+        if prefix_cache_layout:
+            merged.sort(key=lambda n: (n.node.metadata['corpus'], canonical_key(n)))
+        logger.info(f"跨 {len(names)} 个语料检索，合并后保留 {len(merged)} 个节点")
+        
+        # 用不绑定任何索引的共享合成器生成答案，不会因此重新加载被淘汰的语料
+        if self._synthesizer is None:
+            self._synthesizer = get_response_synthesizer(
+                llm=Settings.llm,
+                text_qa_template=prefix_cache_template() if prefix_cache_layout else None
+            )
+        response = synthesize_once(self.single_flight, self.llm_metrics, self._synthesizer, query_bundle, merged)
+        
+        latency = time.perf_counter() - start
+        context_tokens = packing.get('context_tokens_after') or count_context_tokens(merged)
+        self.query_metrics.record({
+            'fanout_latency_s': latency,
+            'fanout_corpora': len(names),
+            'fanout_context_tokens_before': packing.get('context_tokens_before', context_tokens),
+            'fanout_context_tokens_after': context_tokens,
+        })
+        
+        log_sources(response)
+        return str(response)
+    
+    def get_metrics(self) -> Dict[str, object]:
+        """
+        获取注册表状态、跨语料查询指标与各已加载语料的指标
+        
+        Returns:
+            指标字典
+        """
+        fanout = {**self.query_metrics.snapshot(), **self.llm_metrics.snapshot(), **self.single_flight.snapshot()}
+        with self._lock:
+            return {
+                'registered': len(self._corpora),
+                'loaded': list(self._loaded),
+                'pinned': dict(self._pins),
+                'memory_bytes': sum(self._sizes.values()),
+                'memory_budget_bytes': self.memory_budget,
+                'fanout': fanout,
+                'corpora': {name: p.get_metrics() for name, p in self._loaded.items()},
+            }
+
+
 def main():
     """主函数，演示RAG系统的使用"""
     
+    parser = argparse.ArgumentParser(description="基于章节文档的RAG问答")
+    parser.add_argument("--tune", metavar="GOLDEN_JSONL",
+                        help="在标准问题集上搜索切分/检索参数并输出帕累托表，不进入问答")
+    args = parser.parse_args()
+    
+    if args.tune:
+        # 参数搜索只用到本地embedding模型，不配置LLM，也不需要API密钥
+        tuner = RAGDocumentProcessor(
+            documents_dir="./preprocessd_data/satellite_split_output_alter",
+            storage_dir="./storage",
+            use_llm=False
+        )
+        print(tuner.autotune(args.tune))
+        return
+    
     # 创建RAG处理器
     # 方式1: 从环境变量获取API密钥
     # export DEEPSEEK_API_KEY="your_deepseek_api_key"
@@ -310,6 +1105,17 @@ def main():
     #     deepseek_api_key="your_deepseek_api_key_here"
     # )
     
+    # 方式3: 一个进程服务多本手册，按需加载索引并按内存预算LRU淘汰
+    # registry = CorpusRegistry(
+    #     storage_root="./storage/corpora",
+    #     memory_budget_mb=1024,
+    #     engine_kwargs={'similarity_top_k': 5, 'similarity_cutoff': 0.5},
+    #     chunk_size=1024,
+    #     chunk_overlap=100
+    # )
+    # registry.discover("./preprocessd_data")
+    # answer = registry.query("问题", corpora=None)  # None表示跨全部语料检索
+    
     try:
         # 构建向量索引（如果已存在则加载）
         rag_processor.build_vector_index(force_rebuild=False)
@@ -323,11 +1129,15 @@ def main():
         # 创建查询引擎
         rag_processor.create_query_engine(
             similarity_top_k=5,      # 返回最相似的5个文档片段
-            similarity_cutoff=0.5    # 相似度阈值
+            similarity_cutoff=0.5,   # 相似度阈值
+            prefix_cache_layout=True # 固定前缀布局，提高DeepSeek前缀缓存命中
         )
         
+        # 监听文档目录，文件变化时后台重建并热切换索引（可选）
+        # rag_processor.start_hot_reload(poll_interval=5.0)
+        
         print("\n=== RAG系统就绪 ===")
-        print("可以开始查询了！输入 'quit' 或 'exit' 退出\n")
+        print("可以开始查询了！输入 'metrics' 查看指标，'nopack 问题' 跳过上下文压缩查询，输入 'quit' 或 'exit' 退出\n")
         
         # 交互式查询循环
         while True:
@@ -340,9 +1150,19 @@ def main():
             if not question:
                 continue
             
+            if question.lower() == 'metrics':
+                for name, value in rag_processor.get_metrics().items():
+                    print(f"  {name}: {value}")
+                continue
+            
+            # nopack前缀：跳过上下文压缩，用于对比压缩前后的延迟
+            pack_context = not question.lower().startswith('nopack ')
+            if not pack_context:
+                question = question[len('nopack '):].strip()
+            
             try:
                 # 执行查询
-                answer = rag_processor.query(question)
+                answer = rag_processor.query(question, pack_context=pack_context)
                 print(f"\n答案: {answer}\n")
                 print("-" * 50)
                 
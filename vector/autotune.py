@@ -0,0 +1,262 @@
+# 本文件实现切分/检索参数的网格搜索：在标准问题集上评估 recall@k 与成本，输出帕累托表
+#
+# 每组配置走与线上相同的管道：切分 -> MinHash 去重 -> embedding -> Chroma 检索 -> 相似度过滤 -> 上下文压缩，
+# 得分与线上同为余弦相似度，表中的 similarity_cutoff 可以直接用于 create_query_engine。
+# 切分结果与 embedding 都按内容哈希缓存在磁盘上：同一 (文档, chunk_size, chunk_overlap)
+# 只切分一次，同一段文本在不同配置间只算一次 embedding，重复运行几乎不再调用模型。
+
+import json
+import shelve
+import hashlib
+import itertools
+import logging
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from llama_index.core import VectorStoreIndex
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.retrievers import VectorIndexRetriever
+from llama_index.core.schema import Document, MetadataMode, NodeRelationship, QueryBundle, RelatedNodeInfo, TextNode
+from llama_index.core.utils import get_tokenizer
+
+from vector import index_store
+from vector.context_packing import ContextPackingPostprocessor, count_context_tokens
+from vector.dedup import MinHashDeduplicator
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GRID = {
+    'chunk_size': [256, 512, 1024],
+    'chunk_overlap': [0, 50, 100],
+    'similarity_top_k': [3, 5, 8],
+    'similarity_cutoff': [0.3, 0.5, 0.7],
+}
+
+# 切分缓存的记录格式，字段变化时修改以免读到旧格式的缓存
+CHUNK_FORMAT = "v2"
+
+
+def _sha256(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b'\x00')
+    return h.hexdigest()
+
+
+def _record_to_node(record: Dict[str, object]) -> TextNode:
+    node = TextNode(
+        text=record['text'],
+        metadata=record['metadata'],
+        id_=record['id'],
+        start_char_idx=record['start_char_idx'],
+        end_char_idx=record['end_char_idx'],
+    )
+    if record['ref_doc_id']:
+        node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=record['ref_doc_id'])
+    return node
+
+
+def load_golden_set(path: str) -> List[Dict[str, object]]:
+    """
+    读取标准问题集（jsonl），每行形如
+    {"question": "...", "sections": ["3_2", "3_4"]}，sections 为应被检索到的 chapter_section
+    """
+    golden = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                item = json.loads(line)
+                golden.append({'question': item['question'], 'sections': set(item['sections'])})
+    return golden
+
+
+class ArtifactCache:
+    """切分结果与 embedding 的磁盘缓存"""
+
+    def __init__(self, cache_dir: str, embed_model):
+        self.cache_dir = Path(cache_dir)
+        (self.cache_dir / "chunks").mkdir(parents=True, exist_ok=True)
+        self.embed_model = embed_model
+        model_name = getattr(embed_model, 'model_name', type(embed_model).__name__)
+        self._embeddings = shelve.open(str(self.cache_dir / f"embeddings-{_sha256(model_name)[:12]}"))
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self._embeddings.close()
+
+    def chunks(self, documents: Sequence[Document], chunk_size: int, chunk_overlap: int) -> List[TextNode]:
+        """切分文档，结果按 (文档内容哈希, 切分参数) 缓存，保留上下文压缩合并相邻块所需的位置信息"""
+        doc_hashes = [_sha256(doc.text, json.dumps(doc.metadata, sort_keys=True)) for doc in documents]
+        key = _sha256(CHUNK_FORMAT, *doc_hashes, str(chunk_size), str(chunk_overlap))
+        path = self.cache_dir / "chunks" / f"{key}.json"
+        if path.exists():
+            with open(path, 'r', encoding='utf-8') as f:
+                return [_record_to_node(r) for r in json.load(f)]
+
+        parser = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        nodes = parser.get_nodes_from_documents(list(documents))
+        records = []
+        for i, node in enumerate(nodes):
+            # 节点ID由内容决定，不同次运行之间稳定
+            node_id = _sha256(node.get_content(), str(i))[:32]
+            records.append({
+                'id': node_id,
+                'text': node.get_content(),
+                'metadata': node.metadata,
+                'ref_doc_id': node.ref_doc_id,
+                'start_char_idx': node.start_char_idx,
+                'end_char_idx': node.end_char_idx,
+            })
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(records, f, ensure_ascii=False)
+        return [_record_to_node(r) for r in records]
+
+    def embed_nodes(self, nodes: List[TextNode], batch_size: int = 64):
+        """为节点填充 embedding，同样的 embedding 文本只计算一次"""
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        keys = [_sha256('doc', text) for text in texts]
+        missing = [i for i, key in enumerate(keys) if key not in self._embeddings]
+        self.hits += len(nodes) - len(missing)
+        self.misses += len(missing)
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            vectors = self.embed_model.get_text_embedding_batch([texts[i] for i in batch])
+            for i, vector in zip(batch, vectors):
+                self._embeddings[keys[i]] = vector
+        for node, key in zip(nodes, keys):
+            node.embedding = self._embeddings[key]
+
+    def embed_query(self, question: str) -> List[float]:
+        key = _sha256('query', question)
+        if key not in self._embeddings:
+            self._embeddings[key] = self.embed_model.get_query_embedding(question)
+        return self._embeddings[key]
+
+
+def _index_bytes(nodes: List[TextNode]) -> int:
+    """索引体积：float32 向量 + UTF-8 文本"""
+    return sum(len(node.embedding) * 4 + len(node.get_content().encode('utf-8')) for node in nodes)
+
+
+def sweep(documents: Sequence[Document],
+          golden: List[Dict[str, object]],
+          embed_model,
+          cache_dir: str = "./storage/tune_cache",
+          grid: Dict[str, Iterable] = None,
+          dedup_threshold: Optional[float] = 0.9,
+          context_token_budget: Optional[int] = 3072) -> List[Dict[str, object]]:
+    """
+    评估参数网格中的每一组配置
+
+    Args:
+        documents: 全部文档
+        golden: load_golden_set 读取的标准问题集
+        embed_model: embedding 模型
+        cache_dir: 切分与 embedding 缓存目录
+        grid: 参数网格，键同 DEFAULT_GRID
+        dedup_threshold: 近重复去重阈值（与建索引时一致），None 表示不去重
+        context_token_budget: 上下文压缩的 token 预算（与查询引擎一致），None 表示不压缩
+
+    Returns:
+        每组配置一行的结果列表，含 recall、去重后的节点数与索引体积、检索延迟、压缩后的上下文 token 数
+    """
+    if not golden:
+        raise ValueError("标准问题集为空")
+    grid = {**DEFAULT_GRID, **(grid or {})}
+    tokenizer = get_tokenizer()
+    packer = None
+    if context_token_budget is not None:
+        packer = ContextPackingPostprocessor(token_budget=context_token_budget, tokenizer=tokenizer)
+    cache = ArtifactCache(cache_dir, embed_model)
+    rows = []
+    try:
+        query_embeddings = {item['question']: cache.embed_query(item['question']) for item in golden}
+
+        for chunk_size, chunk_overlap in itertools.product(grid['chunk_size'], grid['chunk_overlap']):
+            if chunk_overlap >= chunk_size:
+                continue
+            nodes = cache.chunks(documents, chunk_size, chunk_overlap)
+            parsed = len(nodes)
+            if dedup_threshold is not None:
+                # 与建索引时一样按文档顺序去重，近重复节点不入库
+                dedup = MinHashDeduplicator(threshold=dedup_threshold)
+                nodes = [node for node in nodes if dedup.add(node.node_id, node.get_content()) is None]
+            cache.embed_nodes(nodes)
+            size = _index_bytes(nodes)
+            logger.info(f"chunk_size={chunk_size}, chunk_overlap={chunk_overlap}: "
+                        f"{parsed} 个节点，去重后 {len(nodes)} 个")
+
+            # 与线上一样写入 Chroma（余弦距离、同样的得分换算），节点已带 embedding，不会调用模型
+            store_name = f"tune-{chunk_size}-{chunk_overlap}"
+            store = index_store.open_scratch_store(store_name)
+            try:
+                store.add(nodes)
+                index = VectorStoreIndex.from_vector_store(store, embed_model=embed_model)
+
+                for top_k, cutoff in itertools.product(grid['similarity_top_k'], grid['similarity_cutoff']):
+                    retriever = VectorIndexRetriever(index=index, similarity_top_k=top_k)
+                    recall_sum, latency_sum, token_sum = 0.0, 0.0, 0
+                    for item in golden:
+                        bundle = QueryBundle(item['question'], embedding=query_embeddings[item['question']])
+                        start = time.perf_counter()
+                        results = [n for n in retriever.retrieve(bundle) if (n.score or 0.0) >= cutoff]
+                        if packer is not None:
+                            results = packer.postprocess_nodes(results, query_bundle=bundle)
+                        latency_sum += time.perf_counter() - start
+
+                        found = {n.node.metadata.get('chapter_section') for n in results}
+                        recall_sum += len(found & item['sections']) / max(len(item['sections']), 1)
+                        token_sum += count_context_tokens(results, tokenizer)
+
+                    count = len(golden)
+                    rows.append({
+                        'chunk_size': chunk_size,
+                        'chunk_overlap': chunk_overlap,
+                        'similarity_top_k': top_k,
+                        'similarity_cutoff': cutoff,
+                        'recall': recall_sum / count,
+                        'nodes': len(nodes),
+                        'index_mb': size / 1024 / 1024,
+                        'latency_ms': latency_sum / count * 1000,
+                        'prompt_tokens': token_sum / count,
+                    })
+            finally:
+                index_store.drop_scratch_store(store_name)
+        logger.info(f"embedding缓存: 命中 {cache.hits}，计算 {cache.misses}")
+    finally:
+        cache.close()
+
+    mark_pareto(rows)
+    return rows
+
+
+def mark_pareto(rows: List[Dict[str, object]]):
+    """标出帕累托最优的配置：recall 越高越好，体积、延迟、token 越低越好"""
+    def dominates(a, b):
+        no_worse = (a['recall'] >= b['recall'] and a['index_mb'] <= b['index_mb'] and
+                    a['latency_ms'] <= b['latency_ms'] and a['prompt_tokens'] <= b['prompt_tokens'])
+        better = (a['recall'] > b['recall'] or a['index_mb'] < b['index_mb'] or
+                  a['latency_ms'] < b['latency_ms'] or a['prompt_tokens'] < b['prompt_tokens'])
+        return no_worse and better
+
+    for row in rows:
+        row['pareto'] = not any(dominates(other, row) for other in rows if other is not row)
+
+
+def format_table(rows: List[Dict[str, object]], pareto_only: bool = True) -> str:
+    """输出 Markdown 表格，按 recall 降序、token 升序排列"""
+    header = ("| chunk_size | overlap | top_k | cutoff | recall@k | 节点数 | 索引(MB) "
+              "| 检索延迟(ms) | 上下文tokens |")
+    lines = [header, "|" + "---|" * 9]
+    selected = [r for r in rows if r['pareto'] or not pareto_only]
+    for r in sorted(selected, key=lambda r: (-r['recall'], r['prompt_tokens'])):
+        lines.append(
+            f"| {r['chunk_size']} | {r['chunk_overlap']} | {r['similarity_top_k']} | {r['similarity_cutoff']} "
+            f"| {r['recall']:.3f} | {r['nodes']} | {r['index_mb']:.2f} | {r['latency_ms']:.2f} "
+            f"| {r['prompt_tokens']:.0f} |"
+        )
+    return "\n".join(lines)
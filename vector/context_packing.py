@@ -0,0 +1,168 @@
+# 本文件实现检索结果的上下文压缩：合并相邻块、去掉重叠、按 token 预算裁剪句子
+
+import re
+import threading
+from copy import deepcopy
+from typing import Callable, Dict, List, Optional
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeRelationship, NodeWithScore, QueryBundle
+from llama_index.core.utils import get_tokenizer
+
+# 中文句末标点及换行处切句，标点保留在句子末尾
+_SENTENCE_END = re.compile(r'(?<=[。！？!?；;\n])')
+
+# 每个线程最近一次压缩的统计，查询与检索在同一线程中执行
+_local = threading.local()
+
+
+def last_stats() -> Dict[str, int]:
+    """返回当前线程最近一次上下文压缩的统计"""
+    return dict(getattr(_local, 'stats', {}))
+
+
+def count_context_tokens(nodes: List[NodeWithScore], tokenizer: Optional[Callable] = None) -> int:
+    """统计节点以 LLM 视角（含元数据）展开后的 token 数"""
+    tokenizer = tokenizer or get_tokenizer()
+    return sum(len(tokenizer(n.node.get_content(metadata_mode=MetadataMode.LLM))) for n in nodes)
+
+
+def _bigrams(text: str) -> set:
+    text = re.sub(r'\s+', '', text)
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _suffix_prefix_overlap(a: str, b: str, max_len: int) -> int:
+    """a 的后缀与 b 的前缀最长重合长度（没有字符位置信息时的兜底）"""
+    for n in range(min(len(a), len(b), max_len), 0, -1):
+        if a.endswith(b[:n]):
+            return n
+    return 0
+
+
+class ContextPackingPostprocessor(BaseNodePostprocessor):
+    """
+    在相似度过滤之后压缩送入 LLM 的上下文
+
+    1. 同一 chapter_section 中相邻/重叠的块合并为一个节点，去掉 chunk_overlap 带来的重复文本；
+    2. 总 token 数超过 token_budget 时，按句子得分从低到高删句，直到满足预算。
+       句子得分 = 所在节点相似度 + 与问题的字符二元组重合率。
+    """
+
+    token_budget: int = Field(default=3072, description="上下文 token 上限")
+    max_overlap_chars: int = Field(default=2000, description="无字符位置时查找重叠的最大长度")
+
+    _tokenizer: Callable = PrivateAttr()
+
+    def __init__(self, tokenizer: Optional[Callable] = None, **kwargs):
+        super().__init__(**kwargs)
+        self._tokenizer = tokenizer or get_tokenizer()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextPackingPostprocessor"
+
+    def _count(self, text: str) -> int:
+        return len(self._tokenizer(text)) if text else 0
+
+    def _node_tokens(self, node: NodeWithScore) -> int:
+        return self._count(node.node.get_content(metadata_mode=MetadataMode.LLM))
+
+    def _postprocess_nodes(self,
+                           nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        tokens_before = count_context_tokens(nodes, self._tokenizer)
+
+        packed = self._merge_adjacent(nodes)
+        packed = self._fit_budget(packed, query_bundle.query_str if query_bundle else "")
+
+        _local.stats = {
+            'nodes_before': len(nodes),
+            'nodes_after': len(packed),
+            'context_tokens_before': tokens_before,
+            'context_tokens_after': count_context_tokens(packed, self._tokenizer),
+        }
+        return packed
+
+    def _is_adjacent(self, a: NodeWithScore, b: NodeWithScore) -> bool:
+        """b 是否紧接（或重叠于）a 之后"""
+        if a.node.ref_doc_id != b.node.ref_doc_id:
+            return False
+        next_info = a.node.relationships.get(NodeRelationship.NEXT)
+        if next_info is not None and next_info.node_id == b.node.node_id:
+            return True
+        a_end, b_start = a.node.end_char_idx, b.node.start_char_idx
+        return a_end is not None and b_start is not None and b_start <= a_end
+
+    def _merge_adjacent(self, nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """合并同一章节中相邻的块，合并后的得分取最大值"""
+        def position(n: NodeWithScore):
+            return (str(n.node.metadata.get('chapter_section', '')),
+                    n.node.ref_doc_id or '',
+                    n.node.start_char_idx if n.node.start_char_idx is not None else -1)
+
+        merged: List[NodeWithScore] = []
+        for item in sorted(nodes, key=position):
+            prev = merged[-1] if merged else None
+            if (prev is None or
+                    prev.node.metadata.get('chapter_section') != item.node.metadata.get('chapter_section') or
+                    not self._is_adjacent(prev, item)):
+                merged.append(item)
+                continue
+
+            prev_text, text = prev.node.get_content(), item.node.get_content()
+            a_end, b_start = prev.node.end_char_idx, item.node.start_char_idx
+            if a_end is not None and b_start is not None:
+                overlap = max(a_end - b_start, 0)
+            else:
+                overlap = _suffix_prefix_overlap(prev_text, text, self.max_overlap_chars)
+
+            node = deepcopy(prev.node)
+            node.set_content(prev_text + text[overlap:])
+            if item.node.end_char_idx is not None:
+                node.end_char_idx = max(a_end or 0, item.node.end_char_idx)
+            next_info = item.node.relationships.get(NodeRelationship.NEXT)
+            if next_info is not None:
+                node.relationships[NodeRelationship.NEXT] = next_info
+            merged[-1] = NodeWithScore(node=node, score=max(prev.score or 0.0, item.score or 0.0))
+
+        # 保持原来的相似度降序
+        merged.sort(key=lambda n: n.score or 0.0, reverse=True)
+        return merged
+
+    def _fit_budget(self, nodes: List[NodeWithScore], query: str) -> List[NodeWithScore]:
+        """超出预算时从得分最低的句子开始删除"""
+        total = sum(self._node_tokens(n) for n in nodes)
+        if total <= self.token_budget:
+            return nodes
+
+        query_grams = _bigrams(query)
+        sentences = []  # (得分, 节点序号, 句子序号, token数)
+        split_texts = []
+        for i, n in enumerate(nodes):
+            parts = [p for p in _SENTENCE_END.split(n.node.get_content()) if p]
+            split_texts.append(parts)
+            for j, sentence in enumerate(parts):
+                grams = _bigrams(sentence)
+                overlap = len(grams & query_grams) / len(query_grams) if query_grams else 0.0
+                sentences.append(((n.score or 0.0) + overlap, i, j, self._count(sentence)))
+
+        dropped = set()
+        for score, i, j, tokens in sorted(sentences, key=lambda s: s[0]):
+            if total <= self.token_budget:
+                break
+            dropped.add((i, j))
+            total -= tokens
+
+        packed = []
+        for i, n in enumerate(nodes):
+            kept = [s for j, s in enumerate(split_texts[i]) if (i, j) not in dropped]
+            if not kept:
+                continue
+            if len(kept) < len(split_texts[i]):
+                node = deepcopy(n.node)
+                node.set_content(''.join(kept))
+                n = NodeWithScore(node=node, score=n.score)
+            packed.append(n)
+        return packed
@@ -0,0 +1,112 @@
+# 本文件实现基于 MinHash/LSH 的近重复文本块检测，用于建索引前去除重复节点
+
+import re
+import zlib
+import random
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# 2^31-1，a*h+b 在 uint64 内不会溢出
+_PRIME = (1 << 31) - 1
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _optimal_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    选择 LSH 的 (bands, rows)，使 S 曲线的拐点 (1/b)^(1/r) 最接近阈值
+
+    拐点略低于阈值时优先，宁可多出候选再用签名精确过滤，也不漏掉重复。
+    """
+    best, best_err = (num_perm, 1), float('inf')
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if bands == 0:
+            break
+        knee = (1.0 / bands) ** (1.0 / rows)
+        err = abs(knee - threshold) + (0.05 if knee > threshold else 0.0)
+        if err < best_err:
+            best, best_err = (bands, rows), err
+    return best
+
+
+class MinHashDeduplicator:
+    """
+    增量式近重复检测：依次加入文本，返回与之近似重复的已保留文本ID
+
+    相似度为字符 shingle 集合的 Jaccard 系数（由 MinHash 签名估计），
+    中文文本不依赖分词，按去掉空白后的连续 shingle_size 个字符切分。
+    """
+
+    def __init__(self,
+                 threshold: float = 0.9,
+                 num_perm: int = 128,
+                 shingle_size: int = 5,
+                 seed: int = 1):
+        if not 0.0 < threshold <= 1.0:
+            raise ValueError("threshold 必须在 (0, 1] 范围内")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = _optimal_bands(threshold, num_perm)
+
+        # 固定种子，保证断点续建时签名一致
+        rng = random.Random(seed)
+        self._a = np.array([rng.randrange(1, _PRIME) for _ in range(num_perm)], dtype=np.uint64)
+        self._b = np.array([rng.randrange(0, _PRIME) for _ in range(num_perm)], dtype=np.uint64)
+
+        self._buckets: List[Dict[bytes, List[str]]] = [defaultdict(list) for _ in range(self.bands)]
+        self._signatures: Dict[str, np.ndarray] = {}
+
+    def signature(self, text: str) -> np.ndarray:
+        """计算文本的 MinHash 签名"""
+        text = _WHITESPACE.sub('', text)
+        k = self.shingle_size
+        shingles = {text[i:i + k] for i in range(max(len(text) - k + 1, 1))}
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode('utf-8')) for s in shingles),
+            dtype=np.uint64,
+            count=len(shingles)
+        ) % np.uint64(_PRIME)
+        permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % np.uint64(_PRIME)
+        return permuted.min(axis=1)
+
+    def similarity(self, sig1: np.ndarray, sig2: np.ndarray) -> float:
+        """由签名估计 Jaccard 相似度"""
+        return float(np.mean(sig1 == sig2))
+
+    def add(self, key: str, text: str) -> Optional[str]:
+        """
+        加入一段文本
+
+        Args:
+            key: 文本ID（节点ID）
+            text: 文本内容
+
+        Returns:
+            若与已保留文本近似重复，返回最相似的已保留文本ID（本文本不入库）；
+            否则返回 None，本文本作为代表被保留
+        """
+        sig = self.signature(text)
+        band_keys = [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+        candidates = set()
+        for bucket, band_key in zip(self._buckets, band_keys):
+            candidates.update(bucket.get(band_key, ()))
+
+        best, best_sim = None, self.threshold
+        for candidate in candidates:
+            sim = self.similarity(sig, self._signatures[candidate])
+            if sim >= best_sim:
+                best, best_sim = candidate, sim
+        if best is not None:
+            return best
+
+        self._signatures[key] = sig
+        for bucket, band_key in zip(self._buckets, band_keys):
+            bucket[band_key].append(key)
+        return None
+
+    def __len__(self) -> int:
+        return len(self._signatures)
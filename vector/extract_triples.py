@@ -1,10 +1,12 @@
 
 import json
 import logging
-from typing import Any, Coroutine
+from concurrent.futures import Future, ThreadPoolExecutor
 from rich.logging import RichHandler
+from langchain_core.prompts import PromptTemplate
 from langchain_litellm import ChatLiteLLM
-from vector.prompts import PromptTemplate
+from vector.llm_client import configure_litellm, connection_stats
+from vector.template import triple_prompt_template
 
 logger = logging.getLogger("triple_extractor")
 logging.basicConfig(
@@ -24,14 +26,17 @@ def extract_triples(input_txt_path: str, output_json_path: str):
         datefmt="[%X]",
         handlers=[RichHandler(rich_tracebacks=True, show_time=False, markup=True)],
     )
+    # 与问答共用同一个有界 keep-alive 连接池
+    http_handler = configure_litellm()
     llm = ChatLiteLLM(
         model="deepseek/deepseek-chat",
         temperature=0.7,
+        model_kwargs={"client": http_handler},
     )
-    # FIX: Add 'await' here to get the actual result, not the coroutine.
     result = extract_requirement_triples(llm=llm, content=content)
     with open(output_json_path, "w", encoding="utf-8") as f:
         json.dump(result, f, ensure_ascii=False, indent=4)
+    logger.info(f"🔌 连接复用情况：{connection_stats.snapshot()}")
 
 # --- 加载 txt 文件并分段 ---
 def split_paragraphs(content: str) -> list[str]:
@@ -71,6 +76,7 @@ def extract_requirement_triples(
     content: str,
     window_size=4,
     step=3,
+    max_workers=8,
 ) -> dict:
     """
     从输入文本中提取需求相关的三元组，并返回 JSON 。
@@ -78,33 +84,36 @@ def extract_requirement_triples(
         content (str): 输入文本文件内容
         window_size (int): 窗口大小，默认为4段
         step (int): 步长，默认为3段
+        max_workers (int): 并发请求数，不宜超过连接池大小
     """
     paragraphs = split_paragraphs(content)
     output_triples = []
 
-    tasks: list[Coroutine[Any, Any, str]] = []
+    tasks: list[Future] = []
     total_windows = (len(paragraphs) - window_size) // step + 1
 
-    for i in range(total_windows):
-        start_idx = i * step
-        window_paragraphs = paragraphs[start_idx : start_idx + window_size]
-
-        # 确保有4段
-        if len(window_paragraphs) < window_size:
-            break
-
-        tasks.append(
-            extract_triples_from_paragraphs(
-                llm=llm,
-                p1=window_paragraphs[0],
-                p2=window_paragraphs[1],
-                p3=window_paragraphs[2],
-                p4=window_paragraphs[3],
-                logger=logger,
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i in range(total_windows):
+            start_idx = i * step
+            window_paragraphs = paragraphs[start_idx : start_idx + window_size]
+
+            # 确保有4段
+            if len(window_paragraphs) < window_size:
+                break
+
+            tasks.append(
+                executor.submit(
+                    extract_triples_from_paragraphs,
+                    llm=llm,
+                    p1=window_paragraphs[0],
+                    p2=window_paragraphs[1],
+                    p3=window_paragraphs[2],
+                    p4=window_paragraphs[3],
+                    logger=logger,
+                )
             )
-        )
 
-    results = await asyncio.gather(*tasks)
+        results = [task.result() for task in tasks]
 
     for i, result in enumerate(results):
         try:
@@ -0,0 +1,299 @@
+# 本文件提供流式建索引所需的磁盘存储：Chroma 向量库（向量与节点文本一起增量写入）、
+# 追加写的构建断点与去重映射。构建时内存中只有当前批次的节点，每次落盘只写新增部分。
+
+import json
+import math
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import chromadb
+from llama_index.core import StorageContext, VectorStoreIndex, load_index_from_storage
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import VectorStoreQuery, VectorStoreQueryResult
+from llama_index.vector_stores.chroma import ChromaVectorStore
+
+logger = logging.getLogger(__name__)
+
+CHROMA_DIRNAME = "chroma"
+CHROMA_COLLECTION = "nodes"
+# 线上索引与参数搜索使用同样的距离，得分经 CosineChromaVectorStore 换算为余弦相似度
+CHROMA_METADATA = {"hnsw:space": "cosine"}
+# 追加写的构建断点，存在即表示该目录下的索引尚未构建完成
+BUILD_CHECKPOINT = "build_checkpoint.jsonl"
+# 被去重丢弃的节点 -> 代表节点 的映射，每行一条
+DEDUP_MAP = "dedup_map.jsonl"
+# 检索结果元数据中记录重复出处（章节）的字段
+DUPLICATES_KEY = "duplicate_sections"
+
+# 每个索引目录只打开一个 chroma 客户端，release() 时关闭
+_clients_lock = threading.Lock()
+_clients: Dict[str, object] = {}
+
+
+def content_hash(text: str) -> str:
+    """文件内容哈希，用于判断断点之后文件是否被修改"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def has_disk_store(index_path: Path) -> bool:
+    return (Path(index_path) / CHROMA_DIRNAME).exists()
+
+
+def _chroma_path(index_path: Path) -> str:
+    return str((Path(index_path) / CHROMA_DIRNAME).resolve())
+
+
+def _client(index_path: Path):
+    path = _chroma_path(index_path)
+    with _clients_lock:
+        client = _clients.get(path)
+        if client is None:
+            client = _clients[path] = chromadb.PersistentClient(path=path)
+        return client
+
+
+def release(index_path: Path):
+    """
+    关闭索引目录的 chroma 客户端，释放常驻内存的 HNSW 索引与 sqlite 句柄
+
+    chromadb 按路径在进程内缓存 System，只丢掉 Python 引用不会释放；
+    删除或淘汰索引前必须调用。之后再打开同一目录会重新加载。
+    """
+    with _clients_lock:
+        client = _clients.pop(_chroma_path(index_path), None)
+    if client is None:
+        return
+    if hasattr(client, 'close'):
+        client.close()
+    else:
+        # 旧版 chromadb 没有 close()：直接停止并移出按路径缓存的 System
+        from chromadb.api.shared_system_client import SharedSystemClient
+        system = SharedSystemClient._identifier_to_system.pop(_chroma_path(index_path), None)
+        if system is not None:
+            system.stop()
+    logger.info(f"已释放索引存储: {index_path}")
+
+
+class CosineChromaVectorStore(ChromaVectorStore):
+    """
+    返回余弦相似度的 Chroma 向量库
+
+    ChromaVectorStore 把距离换算为 exp(-distance)，与内存向量库（旧 JSON 索引、参数搜索）
+    直接返回的余弦相似度不是一个尺度，同一个 similarity_cutoff 的过滤效果不同。
+    集合使用余弦距离 distance = 1 - cos，这里换算回 1 - distance。
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CosineChromaVectorStore"
+
+    def query(self, query: VectorStoreQuery, **kwargs) -> VectorStoreQueryResult:
+        result = super().query(query, **kwargs)
+        if result.similarities:
+            # exp(-d) -> 1 - d
+            result.similarities = [1.0 + math.log(s) if s > 0 else -1.0 for s in result.similarities]
+        return result
+
+
+def open_vector_store(index_path: Path) -> CosineChromaVectorStore:
+    """打开（或创建）索引目录下的 Chroma 向量库（余弦距离，得分为余弦相似度）"""
+    collection = _client(index_path).get_or_create_collection(CHROMA_COLLECTION, metadata=CHROMA_METADATA)
+    return CosineChromaVectorStore(chroma_collection=collection)
+
+
+def open_scratch_store(name: str) -> CosineChromaVectorStore:
+    """进程内的临时 Chroma 集合（不落盘），检索与打分和线上索引一致，用于参数搜索"""
+    client = chromadb.EphemeralClient()
+    drop_scratch_store(name)
+    return CosineChromaVectorStore(chroma_collection=client.create_collection(name, metadata=CHROMA_METADATA))
+
+
+def drop_scratch_store(name: str):
+    try:
+        chromadb.EphemeralClient().delete_collection(name)
+    except Exception:
+        # 集合不存在（不同版本的 chromadb 抛出的异常类型不同）
+        pass
+
+
+def load_index(index_path: Path) -> VectorStoreIndex:
+    """加载索引：磁盘向量库优先，兼容旧的 JSON 持久化格式"""
+    if has_disk_store(index_path):
+        return VectorStoreIndex.from_vector_store(open_vector_store(index_path))
+    storage_context = StorageContext.from_defaults(persist_dir=str(index_path))
+    return load_index_from_storage(storage_context)
+
+
+def clear_build(index_path: Path):
+    """删除未完成或需要重建的索引：向量库集合、断点与去重映射"""
+    index_path = Path(index_path)
+    if has_disk_store(index_path):
+        # 删除集合而不是目录：同一进程内 chromadb 会缓存按路径打开的客户端
+        try:
+            _client(index_path).delete_collection(CHROMA_COLLECTION)
+        except Exception:
+            # 集合不存在（不同版本的 chromadb 抛出的异常类型不同）
+            pass
+    for name in (BUILD_CHECKPOINT, DEDUP_MAP):
+        (index_path / name).unlink(missing_ok=True)
+
+
+def iter_stored_texts(vector_store: ChromaVectorStore, page_size: int = 1000) -> Iterator[Tuple[str, str]]:
+    """分页读出向量库中的 (节点ID, 文本)，不一次性载入全部节点"""
+    collection = vector_store._collection
+    offset = 0
+    while True:
+        page = collection.get(include=["documents"], limit=page_size, offset=offset)
+        if not page['ids']:
+            return
+        yield from zip(page['ids'], page['documents'])
+        offset += len(page['ids'])
+
+
+def stale_node_ids(vector_store: ChromaVectorStore, keep: Set[str]) -> List[str]:
+    """向量库中不属于 keep 中文件的节点ID（只取ID，不取向量和文本）"""
+    if not keep:
+        return vector_store._collection.get(include=[])['ids']
+    return vector_store._collection.get(where={"filename": {"$nin": sorted(keep)}}, include=[])['ids']
+
+
+def delete_nodes(vector_store: ChromaVectorStore, node_ids: List[str], batch_size: int = 1000):
+    for start in range(0, len(node_ids), batch_size):
+        vector_store._collection.delete(ids=node_ids[start:start + batch_size])
+
+
+class BuildCheckpoint:
+    """
+    追加写的构建断点
+
+    第一行记录构建参数，之后每次落盘追加一行，记录本批完成的文件：
+    {文件名: {'hash': 内容哈希, 'parsed': 解析节点数, 'dropped': 去重丢弃数}}。
+    """
+
+    def __init__(self, index_path: Path, params: Dict[str, object]):
+        self.path = Path(index_path) / BUILD_CHECKPOINT
+        self.params = params
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def load(self) -> Optional[Dict[str, Dict[str, object]]]:
+        """读取已完成的文件，参数不一致或文件损坏时返回 None"""
+        if not self.path.exists():
+            return None
+        files: Dict[str, Dict[str, object]] = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = [line for line in f if line.strip()]
+            if not lines or json.loads(lines[0]) != self.params:
+                logger.warning("构建断点的参数与当前不一致，将从头构建")
+                return None
+            for line in lines[1:]:
+                try:
+                    files.update(json.loads(line))
+                except ValueError:
+                    # 最后一行可能在写入时被中断，其中的文件会被重新处理
+                    continue
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取构建断点失败: {e}，将从头构建")
+            return None
+        return files
+
+    def start(self, files: Optional[Dict[str, Dict[str, object]]] = None):
+        """写入参数行（及续建时修正后的已完成文件），开始新的断点"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.params, ensure_ascii=False) + "\n")
+            if files:
+                f.write(json.dumps(files, ensure_ascii=False) + "\n")
+        tmp.replace(self.path)
+
+    def record(self, files: Dict[str, Dict[str, object]]):
+        if not files:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(files, ensure_ascii=False) + "\n")
+
+    def finish(self):
+        self.path.unlink(missing_ok=True)
+
+
+class DedupLog:
+    """追加写的去重映射：每行 {'node_id', 'representative', 'chapter_section', 'filename'}"""
+
+    def __init__(self, index_path: Path):
+        self.path = Path(index_path) / DEDUP_MAP
+
+    def read(self) -> List[Dict[str, str]]:
+        if not self.path.exists():
+            return []
+        entries = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+        return entries
+
+    def append(self, entries: List[Dict[str, str]]):
+        if not entries:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def rewrite(self, entries: List[Dict[str, str]]):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        tmp.replace(self.path)
+
+    def sections_by_representative(self) -> Dict[str, List[str]]:
+        """代表节点ID -> 被合并掉的重复节点所在章节"""
+        sections: Dict[str, List[str]] = {}
+        for entry in self.read():
+            found = sections.setdefault(entry['representative'], [])
+            if entry.get('chapter_section') and entry['chapter_section'] not in found:
+                found.append(entry['chapter_section'])
+        return sections
+
+
+class DuplicateSourcesPostprocessor(BaseNodePostprocessor):
+    """
+    给检索到的代表节点标注去重时被合并掉的重复出处，引用时可以一并列出
+
+    出处只写在返回的节点元数据上，不参与 embedding 也不发送给 LLM。
+    """
+
+    index_path: str = Field(description="索引目录（含去重映射）")
+
+    _sections: Dict[str, List[str]] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._sections = DedupLog(Path(self.index_path)).sections_by_representative()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "DuplicateSourcesPostprocessor"
+
+    def _postprocess_nodes(self,
+                           nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        for n in nodes:
+            sections = self._sections.get(n.node.node_id)
+            if not sections:
+                continue
+            n.node.metadata[DUPLICATES_KEY] = list(sections)
+            for excluded in (n.node.excluded_embed_metadata_keys, n.node.excluded_llm_metadata_keys):
+                if DUPLICATES_KEY not in excluded:
+                    excluded.append(DUPLICATES_KEY)
+        return nodes
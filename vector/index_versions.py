@@ -0,0 +1,203 @@
+# 本文件提供索引热更新所需的版本化存储与文档目录监听
+
+import shutil
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+VERSIONS_DIRNAME = "versions"
+CURRENT_FILENAME = "CURRENT"
+# 尚未热更新过时，storage/index 下的初始索引使用的版本名（不在 versions 目录中，不会被清理）
+BASE_VERSION = "index"
+
+
+class VersionedIndexStore:
+    """
+    管理 storage/versions/<版本号> 下的多个索引版本
+
+    当前版本记录在 storage/CURRENT 中，重启后仍能加载最新版本。
+    查询通过 acquire() 持有某个版本的引用，切换后旧版本在引用归零时被清理。
+    """
+
+    def __init__(self, storage_dir: Path, on_release: Optional[Callable[[Path], None]] = None):
+        """
+        Args:
+            storage_dir: 存储根目录
+            on_release: 版本不再被引用、删除其目录之前调用，参数为版本目录，用于释放该版本打开的资源
+        """
+        self.storage_dir = Path(storage_dir)
+        self.versions_dir = self.storage_dir / VERSIONS_DIRNAME
+        self.on_release = on_release
+        self._lock = threading.Lock()
+        self._current: Optional[str] = None
+        self._payloads: Dict[str, Any] = {}
+        self._refs: Dict[str, int] = {}
+        self._building = set()
+
+    def current_dir(self) -> Optional[Path]:
+        """返回 CURRENT 指向的版本目录，不存在时返回 None"""
+        version = self._pointer_name()
+        if not version:
+            return None
+        version_dir = self.versions_dir / version
+        return version_dir if version_dir.exists() else None
+
+    def new_version_dir(self) -> Tuple[str, Path]:
+        """分配一个新的版本号及其目录（目录由调用方写入），构建期间不会被清理"""
+        version = time.strftime("%Y%m%d-%H%M%S") + f"-{time.time_ns() % 1000000:06d}"
+        with self._lock:
+            self._building.add(version)
+        return version, self.versions_dir / version
+
+    def version_dir(self, version: str) -> Path:
+        """版本对应的目录，BASE_VERSION 对应 storage/index"""
+        if version == BASE_VERSION:
+            return self.storage_dir / BASE_VERSION
+        return self.versions_dir / version
+
+    def discard(self, version: str):
+        """放弃一个构建失败的版本"""
+        with self._lock:
+            self._building.discard(version)
+        self._release(version)
+        shutil.rmtree(self.versions_dir / version, ignore_errors=True)
+
+    def publish(self, version: str, payload: Any):
+        """
+        原子地把 payload 设为当前版本，并更新 CURRENT 指针
+
+        对当前版本再次 publish 会替换其 payload（如查询参数变化），已持有旧 payload 的查询不受影响。
+        """
+        pointer = self.storage_dir / CURRENT_FILENAME
+        tmp = pointer.with_suffix(".tmp")
+        if version != BASE_VERSION:
+            tmp.write_text(version, encoding='utf-8')
+        with self._lock:
+            if version != BASE_VERSION:
+                tmp.replace(pointer)
+            self._building.discard(version)
+            self._current = version
+            self._payloads[version] = payload
+            self._refs.setdefault(version, 0)
+        logger.info(f"索引版本已切换到: {version}")
+        self.cleanup()
+
+    @contextmanager
+    def acquire(self) -> Iterator[Tuple[Optional[str], Any]]:
+        """持有当前版本直至 with 块结束，期间切换不会影响本次查询"""
+        with self._lock:
+            version = self._current
+            payload = self._payloads.get(version) if version else None
+            if version is not None:
+                self._refs[version] += 1
+        try:
+            yield version, payload
+        finally:
+            if version is not None:
+                with self._lock:
+                    self._refs[version] -= 1
+                self.cleanup()
+
+    def cleanup(self):
+        """删除非当前且不再被引用的旧版本（内存与磁盘）"""
+        with self._lock:
+            current = self._current or self._pointer_name()
+            stale = [v for v, n in self._refs.items() if v != current and n == 0]
+            for version in stale:
+                del self._refs[version]
+                self._payloads.pop(version, None)
+            protected = set(self._refs) | self._building | {current}
+        # 先释放旧版本在进程内打开的索引，再删除目录
+        for version in stale:
+            self._release(version)
+        if not self.versions_dir.exists():
+            return
+        # 包括上次运行遗留、从未加载过的版本目录
+        for version_dir in self.versions_dir.iterdir():
+            if version_dir.name not in protected:
+                shutil.rmtree(version_dir, ignore_errors=True)
+                logger.info(f"已清理旧索引版本: {version_dir.name}")
+
+    def close(self):
+        """丢弃所有版本的 payload 并释放其资源（不删除目录），用于卸载整个索引"""
+        with self._lock:
+            versions = list(self._payloads)
+            self._payloads.clear()
+            self._refs.clear()
+            self._current = None
+        for version in versions:
+            self._release(version)
+
+    def _release(self, version: str):
+        if self.on_release is None:
+            return
+        try:
+            self.on_release(self.version_dir(version))
+        except Exception as e:
+            logger.warning(f"释放索引版本 {version} 失败: {e}")
+
+    def _pointer_name(self) -> Optional[str]:
+        pointer = self.storage_dir / CURRENT_FILENAME
+        return pointer.read_text(encoding='utf-8').strip() if pointer.exists() else None
+
+
+def snapshot_directory(directory: Path, pattern: str = "*.txt") -> Dict[str, Tuple[int, int]]:
+    """记录目录下文件的 (mtime_ns, size)，用于判断文档是否变化"""
+    snapshot = {}
+    for f in Path(directory).glob(pattern):
+        try:
+            stat = f.stat()
+        except FileNotFoundError:
+            continue
+        snapshot[f.name] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+class DirectoryWatcher(threading.Thread):
+    """
+    轮询监听文档目录，文件新增/修改/删除且稳定一个周期后触发回调
+
+    回调在本线程中执行，因此一次重建完成前不会开始下一次。
+    """
+
+    def __init__(self,
+                 directory: Path,
+                 on_change: Callable[[], None],
+                 poll_interval: float = 5.0,
+                 pattern: str = "*.txt"):
+        super().__init__(name="index-watcher", daemon=True)
+        self.directory = Path(directory)
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.pattern = pattern
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        last = snapshot_directory(self.directory, self.pattern)
+        pending = None
+        while not self._stop_event.wait(self.poll_interval):
+            current = snapshot_directory(self.directory, self.pattern)
+            if current == last:
+                pending = None
+                continue
+            # 等文件写入稳定（连续两次快照一致）再重建，避免读到半个文件
+            if current != pending:
+                pending = current
+                continue
+            logger.info("检测到文档目录变化，开始后台重建索引...")
+            try:
+                self.on_change()
+            except Exception as e:
+                # 不更新 last，下一个周期重试
+                logger.error(f"后台重建索引失败: {e}，将在下个周期重试")
+            else:
+                last = current
+            pending = None
@@ -0,0 +1,241 @@
+# 本文件为所有 LLM 调用提供共享的 HTTP 连接池与在途请求合并（single-flight）
+
+import hashlib
+import threading
+import weakref
+import logging
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import httpx
+import litellm
+from litellm.llms.custom_httpx.http_handler import HTTPHandler
+
+logger = logging.getLogger(__name__)
+
+# 连接池默认参数：DeepSeek 单域名，连接数不必太大，但需要保持长连接
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_MAX_KEEPALIVE = 10
+DEFAULT_KEEPALIVE_EXPIRY = 60.0
+DEFAULT_TIMEOUT = 120.0
+
+_client_lock = threading.Lock()
+_http_client: Optional[httpx.Client] = None
+_litellm_handler: Optional[HTTPHandler] = None
+
+
+class ConnectionStats:
+    """统计共享连接池的请求数与连接复用情况"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 弱引用：连接关闭、网络流被回收后自动移除，不会被新连接误认成复用
+        self._seen_streams: "weakref.WeakSet" = weakref.WeakSet()
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+
+    def on_response(self, response: httpx.Response):
+        """httpx 响应钩子：根据底层网络流判断本次请求是否复用了已有连接"""
+        stream = response.extensions.get("network_stream")
+        with self._lock:
+            self.requests += 1
+            if stream is None:
+                return
+            if stream in self._seen_streams:
+                self.reused_connections += 1
+            else:
+                self._seen_streams.add(stream)
+                self.new_connections += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            observed = self.new_connections + self.reused_connections
+            return {
+                'http_requests': self.requests,
+                'http_new_connections': self.new_connections,
+                'http_reused_connections': self.reused_connections,
+                'http_reuse_rate': self.reused_connections / observed if observed else 0.0,
+            }
+
+
+connection_stats = ConnectionStats()
+
+
+def get_http_client(max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                    max_keepalive_connections: int = DEFAULT_MAX_KEEPALIVE,
+                    keepalive_expiry: float = DEFAULT_KEEPALIVE_EXPIRY) -> httpx.Client:
+    """
+    获取进程内共享的 HTTP 客户端（有界连接池 + keep-alive）
+
+    仅第一次调用时的参数生效，之后返回同一个客户端。
+    """
+    global _http_client
+    with _client_lock:
+        if _http_client is None:
+            limits = httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            )
+            _http_client = httpx.Client(
+                limits=limits,
+                timeout=DEFAULT_TIMEOUT,
+                event_hooks={'response': [connection_stats.on_response]},
+            )
+            logger.info(f"创建共享HTTP连接池: max_connections={max_connections}, "
+                        f"max_keepalive={max_keepalive_connections}, keepalive_expiry={keepalive_expiry}s")
+        return _http_client
+
+
+def configure_litellm(**pool_kwargs) -> HTTPHandler:
+    """
+    返回包装了共享连接池的 LiteLLM HTTP 处理器
+
+    deepseek 等走 base_llm_http_handler 的提供方不读取 litellm.client_session，
+    只有把该处理器作为 client= 传给每次调用才会使用共享连接池：
+    LlamaIndex 的 LiteLLM 通过 additional_kwargs={'client': ...}，
+    LangChain 的 ChatLiteLLM 通过 model_kwargs={'client': ...}。
+    """
+    global _litellm_handler
+    client = get_http_client(**pool_kwargs)
+    with _client_lock:
+        if _litellm_handler is None:
+            _litellm_handler = HTTPHandler(client=client)
+        # 仍读取 client_session 的提供方也走同一个连接池
+        litellm.client_session = client
+        return _litellm_handler
+
+
+class _Call:
+    """一次在途调用，跟随者在 event 上等待领导者的结果"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    在途请求合并：同一个 key 同时只执行一次 fn，其余并发调用共享其结果
+
+    结果不做缓存，领导者返回后下一次相同 key 的调用会重新执行。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.total = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            self.total += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'llm_requests': self.total,
+                'llm_coalesced': self.coalesced,
+                'llm_coalesce_rate': self.coalesced / self.total if self.total else 0.0,
+                'llm_in_flight': len(self._calls),
+            }
+
+
+def context_key(question: str, nodes) -> str:
+    """根据问题与检索到的上下文（节点ID+内容）生成合并键"""
+    h = hashlib.sha256(question.strip().encode('utf-8'))
+    for node in nodes:
+        h.update(b'\x00')
+        h.update(node.node.node_id.encode('utf-8'))
+        h.update(b'\x01')
+        h.update(node.node.get_content().encode('utf-8'))
+    return h.hexdigest()
+
+
+def verify_connection_pool(requests: int = 3) -> Dict[str, Any]:
+    """
+    用本地桩服务器检查 deepseek 调用确实经过共享连接池
+
+    桩服务器返回 OpenAI 格式的应答，不调用真实 API。
+    发出 requests 次 completion 后，http_requests 应增加相同次数，且除第一次外都复用连接。
+
+    Returns:
+        调用前后的 connection_stats 快照
+    """
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            body = json.dumps({
+                'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': 'deepseek-chat',
+                'choices': [{'index': 0, 'finish_reason': 'stop',
+                             'message': {'role': 'assistant', 'content': 'ok'}}],
+                'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2},
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    handler = configure_litellm()
+    before = connection_stats.snapshot()
+    try:
+        for _ in range(requests):
+            litellm.completion(
+                model="deepseek/deepseek-chat",
+                messages=[{'role': 'user', 'content': 'ping'}],
+                api_base=f"http://127.0.0.1:{server.server_address[1]}",
+                api_key="stub",
+                client=handler,
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+    after = connection_stats.snapshot()
+
+    sent = after['http_requests'] - before['http_requests']
+    if sent != requests:
+        raise RuntimeError(f"completion 未经过共享连接池：发出 {requests} 次，连接池记录 {sent} 次")
+    return {'before': before, 'after': after}
+
+
+# 示例使用：python -m vector.llm_client
+if __name__ == "__main__":
+    stats = verify_connection_pool()
+    print(f"共享连接池工作正常: {stats['after']}")
@@ -0,0 +1,36 @@
+# 本文件提供查询级指标的线程安全累计
+
+import threading
+from typing import Dict
+
+
+class QueryMetrics:
+    """
+    累计每次查询上报的数值指标
+
+    snapshot() 给出记录次数（键名为 count_name）、各指标总和与平均值，以及最近一次的原始值。
+    """
+
+    def __init__(self, count_name: str = 'queries'):
+        self.count_name = count_name
+        self._lock = threading.Lock()
+        self._count = 0
+        self._totals: Dict[str, float] = {}
+        self._last: Dict[str, float] = {}
+
+    def record(self, values: Dict[str, float]):
+        with self._lock:
+            self._count += 1
+            for name, value in values.items():
+                self._totals[name] = self._totals.get(name, 0) + value
+            self._last = dict(values)
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            metrics: Dict[str, object] = {self.count_name: self._count}
+            for name, total in self._totals.items():
+                metrics[f'{name}_total'] = total
+                metrics[f'{name}_avg'] = total / self._count if self._count else 0.0
+            for name, value in self._last.items():
+                metrics[f'{name}_last'] = value
+            return metrics
@@ -0,0 +1,239 @@
+# 本文件实现对前缀缓存友好的提示词布局，并统计 API 返回的缓存命中 token
+#
+# DeepSeek 对与历史请求相同的提示词前缀按缓存计费（以 64 token 为单位），
+# 因此把不变的系统/指令放在最前，检索上下文按章节与节点ID排成固定顺序，问题放在最后。
+
+import re
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events.llm import LLMChatEndEvent, LLMCompletionEndEvent
+from llama_index.core.llms import ChatMessage, CompletionResponse, CustomLLM, LLMMetadata, MessageRole
+from llama_index.core.llms.callbacks import llm_completion_callback
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.prompts import ChatPromptTemplate
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from llama_index.core.utils import get_tokenizer
+
+SYSTEM_PROMPT = (
+    "你是一个严谨的技术文档问答助手。"
+    "请只根据下面提供的文档内容回答问题，不要使用文档以外的知识。"
+    "如果文档中没有答案，请直接说明无法从文档中找到答案。"
+    "回答时尽量注明所依据的章节。"
+)
+
+USER_TEMPLATE = (
+    "文档内容如下：\n"
+    "---------------------\n"
+    "{context_str}\n"
+    "---------------------\n"
+    "问题：{query_str}\n"
+    "回答："
+)
+
+
+def prefix_cache_template() -> ChatPromptTemplate:
+    """系统指令在前、上下文居中、问题在后的问答模板"""
+    return ChatPromptTemplate(message_templates=[
+        ChatMessage(role=MessageRole.SYSTEM, content=SYSTEM_PROMPT),
+        ChatMessage(role=MessageRole.USER, content=USER_TEMPLATE),
+    ])
+
+
+def canonical_key(node: NodeWithScore):
+    """按 (章, 节, 节点ID) 排序，缺失章节信息的节点排在最后"""
+    metadata = node.node.metadata
+    match = re.match(r'(\d+)_(\d+)$', str(metadata.get('chapter_section', '')))
+    section = (int(match.group(1)), int(match.group(2))) if match else (float('inf'), float('inf'))
+    return section, node.node.node_id
+
+
+class CanonicalOrderPostprocessor(BaseNodePostprocessor):
+    """把检索结果按章节和节点ID重新排序，相同的节点集合总是得到相同的上下文文本"""
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CanonicalOrderPostprocessor"
+
+    def _postprocess_nodes(self,
+                           nodes: List[NodeWithScore],
+                           query_bundle: Optional[QueryBundle] = None) -> List[NodeWithScore]:
+        return sorted(nodes, key=canonical_key)
+
+
+def extract_usage(raw: Any) -> Dict[str, int]:
+    """
+    从 LLM 原始响应中取出 token 用量
+
+    兼容 DeepSeek 的 prompt_cache_hit_tokens 与 OpenAI 风格的 prompt_tokens_details.cached_tokens。
+    """
+    def get(obj, name):
+        if obj is None:
+            return None
+        if isinstance(obj, dict):
+            return obj.get(name)
+        return getattr(obj, name, None)
+
+    usage = get(raw, 'usage')
+    if usage is None:
+        return {}
+    cached = get(usage, 'prompt_cache_hit_tokens')
+    if cached is None:
+        cached = get(get(usage, 'prompt_tokens_details'), 'cached_tokens')
+    return {
+        'prompt_tokens': get(usage, 'prompt_tokens') or 0,
+        'completion_tokens': get(usage, 'completion_tokens') or 0,
+        'cached_prompt_tokens': cached or 0,
+    }
+
+
+class UsageEventHandler(BaseEventHandler):
+    """监听 LLM 结束事件，把 token 用量累加到当前线程正在收集的字典中"""
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "UsageEventHandler"
+
+    def handle(self, event, **kwargs) -> None:
+        if not isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent)):
+            return
+        target = getattr(_local, 'usage', None)
+        if target is None or event.response is None:
+            return
+        for name, value in extract_usage(event.response.raw).items():
+            target[name] = target.get(name, 0) + value
+
+
+_local = threading.local()
+_handler_lock = threading.Lock()
+_handler: Optional[UsageEventHandler] = None
+
+
+def _ensure_handler():
+    global _handler
+    with _handler_lock:
+        if _handler is None:
+            _handler = UsageEventHandler()
+            get_dispatcher().add_event_handler(_handler)
+
+
+@contextmanager
+def collect_llm_usage() -> Iterator[Dict[str, int]]:
+    """在 with 块内收集当前线程所有 LLM 调用的 token 用量"""
+    _ensure_handler()
+    usage: Dict[str, int] = {}
+    previous = getattr(_local, 'usage', None)
+    _local.usage = usage
+    try:
+        yield usage
+    finally:
+        _local.usage = previous
+
+
+class PrefixCacheStubLLM(CustomLLM):
+    """
+    本地桩模型：不调用 API，按与历史提示词的最长公共前缀模拟前缀缓存
+
+    命中长度按 block_size 向下取整（DeepSeek 以 64 token 为缓存单元），
+    用量以 DeepSeek 的字段名放在 raw['usage'] 中返回。
+    """
+
+    block_size: int = Field(default=64, description="缓存单元大小（token）")
+
+    _history: List[List[int]] = PrivateAttr(default_factory=list)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _tokenizer: Any = PrivateAttr(default=None)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "PrefixCacheStubLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(model_name="prefix-cache-stub", is_chat_model=False)
+
+    def _prefix_hit(self, tokens: List[int]) -> int:
+        with self._lock:
+            best = 0
+            for previous in self._history:
+                n = 0
+                for a, b in zip(tokens, previous):
+                    if a != b:
+                        break
+                    n += 1
+                best = max(best, n)
+            self._history.append(tokens)
+        return best // self.block_size * self.block_size
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        if self._tokenizer is None:
+            self._tokenizer = get_tokenizer()
+        tokens = list(self._tokenizer(prompt))
+        hit = self._prefix_hit(tokens)
+        usage = {
+            'prompt_tokens': len(tokens),
+            'completion_tokens': 0,
+            'prompt_cache_hit_tokens': hit,
+            'prompt_cache_miss_tokens': len(tokens) - hit,
+        }
+        return CompletionResponse(text=f"[stub] prefix hit {hit}/{len(tokens)} tokens", raw={'usage': usage})
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        yield self.complete(prompt, formatted=formatted, **kwargs)
+
+
+def verify_prefix_cache(queries: Sequence[tuple], block_size: int = 64) -> Dict[str, Dict[str, int]]:
+    """
+    用桩模型对比按得分排序与规范排序两种布局的前缀命中
+
+    Args:
+        queries: [(问题, 检索到的NodeWithScore列表), ...]，节点按相似度降序
+        block_size: 缓存单元大小
+
+    Returns:
+        {'score_order': 用量, 'canonical': 用量}
+    """
+    template = prefix_cache_template()
+    layouts = {
+        'score_order': lambda nodes: nodes,
+        'canonical': lambda nodes: sorted(nodes, key=canonical_key),
+    }
+    results = {}
+    for name, order in layouts.items():
+        llm = PrefixCacheStubLLM(block_size=block_size)
+        with collect_llm_usage() as usage:
+            for question, nodes in queries:
+                context = "\n\n".join(
+                    n.node.get_content(metadata_mode=MetadataMode.LLM) for n in order(nodes)
+                )
+                llm.predict(template, context_str=context, query_str=question)
+        results[name] = dict(usage)
+    return results
+
+
+# 示例使用：python -m vector.prompt_layout
+if __name__ == "__main__":
+    from pathlib import Path
+    from llama_index.core.schema import TextNode
+
+    docs_dir = Path("./preprocessd_data/satellite_split_output_alter")
+    nodes = []
+    for name in ["1_1", "1_2", "2_1", "2_2"]:
+        text = (docs_dir / f"{name}.txt").read_text(encoding="utf-8")[:800]
+        nodes.append(TextNode(text=text, id_=f"node-{name}", metadata={'chapter_section': name}))
+
+    # 同一批热门章节，每次检索得分顺序不同
+    queries = [
+        ("卫星系统由哪些部分组成？", [NodeWithScore(node=n, score=s) for n, s in zip(nodes, [0.9, 0.8, 0.7, 0.6])]),
+        ("卫星总体设计的流程是什么？", [NodeWithScore(node=n, score=s) for n, s in zip(nodes, [0.6, 0.9, 0.8, 0.7])]),
+        ("卫星设计有哪些约束？", [NodeWithScore(node=n, score=s) for n, s in zip(nodes, [0.7, 0.6, 0.9, 0.8])]),
+    ]
+    queries = [(q, sorted(ns, key=lambda n: n.score, reverse=True)) for q, ns in queries]
+    for layout, usage in verify_prefix_cache(queries).items():
+        print(f"{layout}: 缓存命中 {usage['cached_prompt_tokens']}/{usage['prompt_tokens']} tokens")